@@ -1,19 +1,43 @@
 import re
+import threading
+import logging
 from os import path
 from glob import glob
 
-from .server import Server
+from .server import Server, command_line, references
+from .pool import ServerPool
+from .watcher import WATCHER
+from .stats import METRICS
+# The asyncio client needs Python 3.5+
+try:
+    from .aio import AsyncServer
+except (ImportError, SyntaxError):
+    AsyncServer = None
 
 
+logger = logging.getLogger('boo')
+
 # Registry of spawned servers
 _SERVERS = {}
+_SERVERS_LOCK = threading.Lock()
 
 IMPORT_RE = re.compile(r'^import\s+([\w\.]+)?|^from\s+([\w\.]+)?')
 CONTINUATION_RE = re.compile(r'[\\,][\s\r\n]*$')
 
 
-def get_server(cmd, args, fname=None, rsp=None, cwd=None):
-    """ Spawn or retrieve a server suitable for the given arguments
+def get_server(cmd, args, fname=None, rsp=None, cwd=None, workers=1, **kwargs):
+    """ Spawn or retrieve a server suitable for the given arguments. The
+        returned pool spreads the queries among `workers` processes, any
+        other keyword argument is used to configure them.
+    """
+    key = server_key(cmd, args, fname, rsp, cwd)
+    return get_server_by_key(key, workers, **kwargs)
+
+
+def server_key(cmd, args, fname=None, rsp=None, cwd=None):
+    """ Resolves the key identifying the server suitable for the given
+        arguments. Locating the rsp file walks up the directories so callers
+        in a hot path should memoize it.
     """
     dirname = path.dirname(path.abspath(fname))
     if rsp is not None:
@@ -29,19 +53,122 @@ def get_server(cmd, args, fname=None, rsp=None, cwd=None):
         args = cmd[1:] + args
         cmd = cmd[0]
 
-    key = (cmd, tuple(args), cwd, rsp)
-    if key not in _SERVERS:
-        _SERVERS[key] = Server(cmd, args, rsp=rsp, cwd=cwd)
+    return (cmd, tuple(args), cwd, rsp)
 
-    return _SERVERS[key]
+
+def get_server_by_key(key, workers=1, watch=True, **kwargs):
+    """ Spawn or retrieve the server for a key obtained with `server_key`.
+        With `watch` it gets refreshed when its rsp file or any referenced
+        assembly changes.
+    """
+    with _SERVERS_LOCK:
+        server = _SERVERS.get(key)
+        if server is not None:
+            return server
+
+        cmd, args, cwd, rsp = key
+        server = ServerPool(cmd, list(args), rsp=rsp, cwd=cwd, workers=workers, **kwargs)
+        server.on_stale = lambda stale: swap_server(key, stale)
+        _SERVERS[key] = server
+
+    if watch:
+        watch_server(key)
+    return server
+
+
+def watch_server(key):
+    """ Watch the rsp file and referenced assemblies of a server """
+    cmd, args, cwd, rsp = key
+    try:
+        args, cwd = command_line((cmd,) + args, rsp, cwd)
+    except (IOError, OSError) as ex:
+        logger.error('Unable to read rsp file: %s', ex)
+        return
+
+    # Missing ones are watched too, a build may create them later
+    paths = references(args, cwd)
+    if rsp is not None:
+        paths.append(rsp)
+    WATCHER.watch(key, paths, lambda: refresh_server(key))
+
+
+def refresh_server(key):
+    """ Called when the references of a server changed, a running one is
+        swapped with a fresh one while an idle one just forgets its hints.
+    """
+    with _SERVERS_LOCK:
+        server = _SERVERS.get(key)
+    if server is None:
+        return
+    if server.is_alive():
+        server.stale()
+    else:
+        server.invalidate()
+
+
+def swap_server(key, stale):
+    """ Replaces a server whose references changed. A fresh one is warmed up
+        in the background while the stale one keeps answering, once ready it
+        takes its place and the stale one is retired after finishing its
+        queries in flight.
+    """
+    def run():
+        fresh = stale.clone()
+        fresh.on_stale = stale.on_stale
+        try:
+            fresh.warm()
+        except Exception as ex:
+            logger.error('Unable to warm up a fresh hint server: %s', ex, exc_info=True)
+            fresh.stop()
+            # Restart the stale processes instead, a later change retries
+            for worker in stale.workers:
+                worker.schedule_restart()
+            return
+        finally:
+            stale.swapping = False
+
+        with _SERVERS_LOCK:
+            swapped = _SERVERS.get(key) is stale
+            if swapped:
+                _SERVERS[key] = fresh
+
+        if swapped:
+            logger.info('Swapped in a fresh hint server for %s', key[3] or key[2])
+            METRICS.count('swaps')
+            stale.retire()
+            # References listed in the rsp may have changed too
+            if WATCHER.watching(key):
+                watch_server(key)
+        else:
+            # Reset while warming up
+            fresh.stop()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
 
 
 def reset_servers():
     """ Closes all tracked servers.
     """
-    for server in _SERVERS.values():
+    with _SERVERS_LOCK:
+        servers = list(_SERVERS.values())
+        _SERVERS.clear()
+    WATCHER.unwatch()
+    for server in servers:
         server.stop()
-    _SERVERS.clear()
+
+
+def watch_rsp(key, fname, pattern, callback):
+    """ Call back when an rsp file matching the pattern is created, changed
+        or removed where `locate_rsp` looks for the one of the given file.
+    """
+    dirname = path.dirname(path.abspath(fname))
+    patterns = []
+    while len(dirname) > 3:
+        patterns.append(path.join(dirname, pattern))
+        dirname = path.dirname(dirname)
+    WATCHER.watch(key, [], callback, patterns)
 
 
 def locate_rsp(dirname, pattern):
@@ -175,6 +302,12 @@ def get_import_namespace(code):
 __all__ = [
     TYPESMAP,
     get_server,
+    server_key,
+    get_server_by_key,
+    swap_server,
+    watch_server,
+    refresh_server,
+    watch_rsp,
     locate_rsp,
     format_type,
     format_method,
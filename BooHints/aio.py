@@ -0,0 +1,293 @@
+"""
+asyncio client for the Boo compiler hints server.
+
+Intended for tools embedding BooHints outside of Sublime, queries are
+coroutines so several of them can be awaited at once with `asyncio.gather`.
+Requires Python 3.5 or later.
+"""
+
+import json
+import asyncio
+import itertools
+import logging
+
+from .server import command_line, encode_query
+
+logger = logging.getLogger('boo.aio')
+
+# Longest line accepted from the server, the builtins or namespaces easily
+# exceed the default limit of the stream readers.
+STREAM_LIMIT = 64 * 1024 * 1024
+
+
+class AsyncServer(object):
+    """ Spawns the hints server using asyncio subprocess pipes. Follows the
+        same protocol as `Server`: queries are pipelined when the server
+        echoes their ids, otherwise they are serialized with a lock.
+    """
+
+    def __init__(self, bin, args=None, rsp=None, cwd=None, timeout=3.0, pipelined=None,
+                 ceiling=30.0):
+        self.args = [bin] + list(args or [])
+        self.rsp = rsp
+        self.cwd = cwd
+        self.timeout = timeout
+        # Longest wait for the late response of a serialized request which
+        # timed out, the process is restarted when it never arrives.
+        self.ceiling = ceiling
+        self.pipelined = pipelined
+        self.proc = None
+        self.pending = {}
+        self._ids = itertools.count(1)
+        self._readers = []
+        self._needs_restart = False
+        # Created once running inside an event loop
+        self._lock = None
+        self._serial = None
+        self._results = None
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+            self._serial = asyncio.Lock()
+            self._results = asyncio.Queue()
+
+        async with self._lock:
+            if self._needs_restart:
+                self._needs_restart = False
+                logger.info('Restarting server...')
+                await self._terminate()
+            # Nothing to do if already running
+            elif self.is_alive():
+                return
+
+            args, cwd = command_line(self.args, self.rsp, self.cwd)
+            self.proc = await asyncio.create_subprocess_exec(
+                *args,
+                cwd=cwd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=STREAM_LIMIT
+            )
+
+            logger.info('Started hint server with PID %s using: %s',
+                        self.proc.pid, ' '.join(args))
+
+            self._readers = [
+                asyncio.ensure_future(self._read_stdout(self.proc)),
+                asyncio.ensure_future(self._read_stderr(self.proc)),
+            ]
+
+    async def stop(self):
+        if self._lock is None:
+            return
+        async with self._lock:
+            await self._terminate()
+
+    async def _terminate(self):
+        proc = self.proc
+        if proc is None:
+            return
+
+        self.proc = None
+        for reader in self._readers:
+            reader.cancel()
+        self._readers = []
+
+        if proc.returncode is None:
+            # Try to terminate the compiler gracefully
+            try:
+                logger.info('Terminating hint server process %s', proc.pid)
+                proc.stdin.write(b'quit\n')
+                proc.terminate()
+                await asyncio.wait_for(proc.wait(), 1.0)
+            except (IOError, asyncio.TimeoutError):
+                pass
+
+        # If still alive try to kill it
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+        self._reset_pending()
+        # Wake up a serialized request or drain waiting for a response
+        self._results.put_nowait(None)
+
+    def _reset_pending(self):
+        """ Wake up every request waiting for a response with an empty one """
+        for future in self.pending.values():
+            if not future.done():
+                future.set_result(None)
+        self.pending.clear()
+
+    async def _read_stdout(self, proc):
+        try:
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+
+                line = line.decode('utf-8').rstrip()
+                if not line:
+                    continue
+                if line.startswith('#'):
+                    line = line[1:]
+                    if line.startswith('!'):
+                        self._server_command(line[1:])
+                    else:
+                        logger.debug(line)
+                else:
+                    self._dispatch(line)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            # Nothing else will be read from this process, restart it
+            logger.error('Error reading from hint server %s: %s', proc.pid, ex, exc_info=True)
+            if proc is self.proc:
+                self._needs_restart = True
+            else:
+                return
+        else:
+            # Ignore processes already stopped or replaced
+            if proc is not self.proc:
+                return
+            logger.warning('Hint server process %s exited', proc.pid)
+
+        self._reset_pending()
+        self._results.put_nowait(None)
+
+    async def _read_stderr(self, proc):
+        while True:
+            line = await proc.stderr.readline()
+            if not line:
+                break
+
+            line = line.decode('utf-8').rstrip()
+            if line.startswith('#'):
+                logger.warning(line[1:])
+            elif line:
+                logger.error(line)
+
+    def _dispatch(self, line):
+        """ Routes a response to the request waiting for it """
+        try:
+            resp = json.loads(line)
+        except Exception as ex:
+            logger.error(str(ex), exc_info=True)
+            resp = None
+
+        qid = resp.get('id') if isinstance(resp, dict) else None
+        if qid is not None:
+            future = self.pending.pop(qid, None)
+            if future is not None:
+                if not future.done():
+                    future.set_result(resp)
+                return
+            if self.pipelined:
+                logger.debug('Discarding response for query %s', qid)
+                return
+
+        self._results.put_nowait(resp)
+
+    def _server_command(self, line):
+        """ Answers server commands
+        """
+        if line.startswith('ReferenceModified:'):
+            # Force a restart of the server with the next request
+            self._needs_restart = True
+        else:
+            logger.info('Unsupported server command: %s', line)
+
+    async def request(self, command, timeout=None, **kwargs):
+        """ Issue a query returning its response, or None if it failed or
+            no response arrived before the timeout (in seconds).
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        await self.start()
+
+        qid = next(self._ids)
+        kwargs['command'] = command
+        kwargs['id'] = qid
+        query = encode_query(kwargs)
+
+        if self.pipelined:
+            resp = await self._request_pipelined(qid, query, timeout)
+        else:
+            resp = await self._request_serialized(qid, query, timeout)
+
+        if isinstance(resp, dict):
+            resp.pop('id', None)
+        return resp
+
+    async def _request_pipelined(self, qid, query, timeout):
+        future = asyncio.get_event_loop().create_future()
+        self.pending[qid] = future
+        try:
+            self.proc.stdin.write(query)
+            await self.proc.stdin.drain()
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            logger.error('Timeout waiting for query response')
+        except (IOError, ConnectionError) as ex:
+            logger.error('Error sending query: %s', ex)
+        finally:
+            self.pending.pop(qid, None)
+
+    async def _request_serialized(self, qid, query, timeout):
+        await self._serial.acquire()
+        draining = False
+        try:
+            # A drain may have restarted the process meanwhile
+            await self.start()
+
+            # Reset the response queue
+            while not self._results.empty():
+                self._results.get_nowait()
+
+            try:
+                self.proc.stdin.write(query)
+                await self.proc.stdin.drain()
+                resp = await asyncio.wait_for(self._results.get(), timeout)
+            except asyncio.TimeoutError:
+                logger.error('Timeout waiting for query response')
+                # The lock is kept until the late response arrives
+                asyncio.ensure_future(self._drain(timeout))
+                draining = True
+                return None
+            except (IOError, ConnectionError) as ex:
+                logger.error('Error sending query: %s', ex)
+                return None
+
+            # Detect if the server supports pipelining with the first response
+            if self.pipelined is None and isinstance(resp, dict):
+                self.pipelined = resp.get('id') == qid
+                logger.info('Hint server %s pipelined queries',
+                            'supports' if self.pipelined else 'does not support')
+
+            return resp
+        finally:
+            if not draining:
+                self._serial.release()
+
+    async def _drain(self, timeout):
+        """ Discards the late response of a serialized request which timed
+            out so the next one does not take it, restarting a process not
+            answering within the ceiling. Releases the serial lock.
+        """
+        try:
+            if self._results.empty():
+                await asyncio.wait_for(self._results.get(), max(0, self.ceiling - timeout))
+            else:
+                self._results.get_nowait()
+            logger.debug('Discarding late response')
+        except asyncio.TimeoutError:
+            logger.error('Hint server never answered, restarting it')
+            await self.stop()
+        finally:
+            self._serial.release()
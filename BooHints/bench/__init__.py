@@ -0,0 +1,263 @@
+"""
+Benchmarks for the hint server client, driving it with realistic mixes of
+queries against a fake server so protocol and client changes can be
+measured without Mono or a real compiler.
+
+    python -m BooHints.bench --scenario mixed --duration 20 --workers 2
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+
+from .. import get_server_by_key, reset_servers
+
+FAKESERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakeserver.py')
+
+SCENARIOS = {
+    'typing': ('typing',),
+    'save': ('save',),
+    'status': ('status',),
+    'mixed': ('typing', 'save', 'status'),
+}
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    return samples[int(round((len(samples) - 1) * p / 100.0))]
+
+
+def process_cpu(pid):
+    """ CPU seconds used by a process, None if unknown """
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as fp:
+            fields = fp.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def cpu_time():
+    try:
+        return time.process_time()
+    except AttributeError:
+        # Python 2
+        return time.clock()
+
+
+def sample_code(lines=2000):
+    """ Source resembling a real Boo module """
+    code = ['import System', 'import System.Collections.Generic', '']
+    for i in range(lines // 10):
+        code.extend([
+            'class Foo{0}:'.format(i),
+            '    _items as List[of int]',
+            '',
+            '    def Add{0}(value as int) as int:'.format(i),
+            '        _items.Add(value)',
+            '        return _items.Count',
+            '',
+            '    def ToString() as string:',
+            '        return "Foo{0}"'.format(i),
+            '',
+        ])
+    return '\n'.join(code) + '\n'
+
+
+class Results(object):
+    """ Latencies and outcome of the queries issued by a benchmark """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.issued = {}
+        self.cancelled = {}
+        self.failed = {}
+        self.threads = 0
+
+    def issue(self, command):
+        with self.lock:
+            self.issued[command] = self.issued.get(command, 0) + 1
+
+    def record(self, command, latency, ok=True):
+        with self.lock:
+            self.latencies.setdefault(command, []).append(latency)
+            if not ok:
+                self.failed[command] = self.failed.get(command, 0) + 1
+
+    def cancel(self, command):
+        with self.lock:
+            self.cancelled[command] = self.cancelled.get(command, 0) + 1
+
+    def report(self, elapsed, client_cpu, server_cpu):
+        ms = lambda x: '{0:.1f}'.format(x * 1000) if x is not None else '-'
+        row = '{0:<12} {1:>7} {2:>7} {3:>10} {4:>10} {5:>7} {6:>9} {7:>9} {8:>9}'
+
+        lines = [row.format('command', 'issued', 'done', 'cancelled', 'superseded',
+                            'failed', 'p50 ms', 'p95 ms', 'p99 ms')]
+        total = 0
+        for command in sorted(self.issued):
+            samples = sorted(self.latencies.get(command, []))
+            total += len(samples)
+            cancelled = self.cancelled.get(command, 0)
+            superseded = self.issued[command] - len(samples) - cancelled
+            lines.append(row.format(
+                command, self.issued[command], len(samples), cancelled, superseded,
+                self.failed.get(command, 0), ms(percentile(samples, 50)),
+                ms(percentile(samples, 95)), ms(percentile(samples, 99))))
+
+        lines.append('')
+        lines.append('Duration:    {0:.1f} s'.format(elapsed))
+        lines.append('Throughput:  {0:.1f} queries/s'.format(total / elapsed))
+        lines.append('Threads:     {0} peak'.format(self.threads))
+        lines.append('Client CPU:  {0:.2f} s ({1:.0%})'.format(client_cpu, client_cpu / elapsed))
+        if server_cpu is not None:
+            lines.append('Server CPU:  {0:.2f} s'.format(server_cpu))
+        return '\n'.join(lines)
+
+
+class Bench(object):
+    """ Simulates the editor issuing queries like the plugin does: blocking
+        completions while typing, coalesced async status lookups and lint
+        queries on save, for several documents at once.
+    """
+
+    def __init__(self, workers=1, sync_documents=False, cache=True, server_args=(),
+                 documents=3, framing=False):
+        self.key = (sys.executable, (FAKESERVER,) + tuple(server_args), os.getcwd(), None)
+        self.options = {
+            'workers': workers,
+            'watch': False,
+            'sync_documents': sync_documents,
+            'cache': None if cache else False,
+            'framing': framing,
+        }
+        self.results = Results()
+        self.documents = {}
+        for i in range(documents):
+            self.documents['/bench/file{0}.boo'.format(i)] = [1, sample_code()]
+        self.running = False
+
+    def server(self, fname=None):
+        """ Obtain the server like the plugin does for every query """
+        server = get_server_by_key(self.key, **self.options)
+        if fname is not None:
+            version, text = self.documents[fname]
+            server.update_document(fname, version, text)
+        return server
+
+    def query(self, fname, command, **kwargs):
+        self.results.issue(command)
+        started = time.time()
+        resp = self.server(fname).query(command, fname=fname, **kwargs)
+        self.results.record(command, time.time() - started, resp is not None)
+        return resp
+
+    def query_async(self, fname, command, stale=None, **kwargs):
+        self.results.issue(command)
+        started = time.time()
+
+        def callback(resp):
+            self.results.record(command, time.time() - started, resp is not None)
+
+        def is_stale():
+            if stale and stale():
+                self.results.cancel(command)
+                return True
+            return False
+
+        self.server(fname).query_async(
+            callback, command, key=(fname, command), stale=is_stale, fname=fname, **kwargs)
+
+    def typing(self):
+        """ Bursts of keystrokes, each one asking for completions """
+        while self.running:
+            fname = random.choice(sorted(self.documents))
+            doc = self.documents[fname]
+            for _ in range(random.randint(3, 12)):
+                if not self.running:
+                    break
+                doc[0] += 1
+                doc[1] += random.choice('abcdefghijklmnopqrstuvwxyz.')
+                version = doc[0]
+                self.query(fname, 'complete', offset=len(doc[1]), line=1)
+                self.query_async(fname, 'entity', stale=lambda doc=doc, v=version: doc[0] != v,
+                                 line=1, column=1)
+                time.sleep(random.uniform(0.05, 0.15))
+            time.sleep(random.uniform(0.3, 1.0))
+            self.query_async(fname, 'locals', line=1)
+
+    def save(self):
+        """ Linting and refreshing the globals on every save """
+        while self.running:
+            time.sleep(random.uniform(1.5, 3.0))
+            fname = random.choice(sorted(self.documents))
+            self.query_async(fname, 'parse')
+            self.query_async(fname, 'globals')
+            self.query_async(fname, 'outline')
+
+    def status(self):
+        """ Polling the entity under the caret for the status bar """
+        while self.running:
+            time.sleep(0.7)
+            fname = random.choice(sorted(self.documents))
+            doc = self.documents[fname]
+            self.query_async(fname, 'entity', line=random.randint(1, 2000), column=5,
+                             stale=lambda doc=doc, v=doc[0]: doc[0] != v)
+
+    def sample_threads(self):
+        while self.running:
+            self.results.threads = max(self.results.threads, threading.active_count())
+            time.sleep(0.1)
+
+    def run(self, scenario='mixed', duration=10.0):
+        """ Run the scenario for the given number of seconds returning a
+            report of the results.
+        """
+        reset_servers()
+        # Spawn the processes beforehand to only measure the steady state
+        self.server().query('builtins', fname='prefetch', code='')
+
+        self.running = True
+        threads = [threading.Thread(target=getattr(self, x)) for x in SCENARIOS[scenario]]
+        threads.append(threading.Thread(target=self.sample_threads))
+        started, cpu = time.time(), cpu_time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        time.sleep(duration)
+        self.running = False
+        for thread in threads:
+            thread.join()
+
+        # Give the async queries a chance to complete
+        deadline = time.time() + 5.0
+        while self.server().is_busy() and time.time() < deadline:
+            time.sleep(0.05)
+
+        elapsed, cpu = time.time() - started, cpu_time() - cpu
+        server_cpu = self.server_cpu()
+        reset_servers()
+        return self.results.report(elapsed, cpu, server_cpu)
+
+    def server_cpu(self):
+        """ CPU used by the server processes, None if unknown """
+        total = 0
+        for worker in self.server().workers:
+            usage = process_cpu(worker.pid()) if worker.pid() else None
+            if usage is None:
+                return None
+            total += usage
+        return total
+
+
+__all__ = [
+    Bench,
+    Results,
+    SCENARIOS,
+    FAKESERVER,
+]
@@ -0,0 +1,59 @@
+"""
+Command line entry point for the benchmarks, see `python -m BooHints.bench -h`
+"""
+
+import sys
+import logging
+import argparse
+
+from . import Bench, SCENARIOS
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m BooHints.bench',
+                                     description='Benchmark the hint server client.')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to run the scenario')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server processes in the pool')
+    parser.add_argument('--sync-documents', action='store_true',
+                        help='send document changes instead of the whole code')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the response cache')
+    parser.add_argument('--framed', action='store_true',
+                        help='use the framed protocol')
+    parser.add_argument('--verbose', action='store_true')
+    # Options for the fake server
+    parser.add_argument('--latency-scale', default='1.0')
+    parser.add_argument('--hints', default='50')
+    parser.add_argument('--reference-modified', default='0',
+                        help='report modified references every N queries')
+    parser.add_argument('--no-ids', action='store_true',
+                        help='serialize the queries as with old servers')
+    parser.add_argument('--page-size', default='0',
+                        help='hints in each page with the framed protocol')
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.WARNING)
+
+    server_args = [
+        '--latency-scale', options.latency_scale,
+        '--hints', options.hints,
+        '--reference-modified', options.reference_modified,
+        '--page-size', options.page_size,
+    ]
+    if options.no_ids:
+        server_args.append('--no-ids')
+
+    bench = Bench(
+        workers=options.workers,
+        sync_documents=options.sync_documents,
+        cache=not options.no_cache,
+        framing=options.framed,
+        server_args=server_args)
+    print(bench.run(options.scenario, options.duration))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
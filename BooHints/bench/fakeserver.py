@@ -0,0 +1,163 @@
+"""
+Stand-in for boohints.exe speaking the same line-delimited JSON protocol,
+with a configurable latency and response size. It does not depend on the
+rest of the package so it can be spawned directly by its path.
+
+    python fakeserver.py --latency-scale 2 --hints 200 --reference-modified 500
+"""
+
+import sys
+import json
+import time
+import struct
+import random
+import argparse
+import threading
+
+# Typical think time of the real server for each command, in seconds
+LATENCIES = {
+    'complete': 0.03,
+    'entity': 0.01,
+    'locals': 0.01,
+    'members': 0.02,
+    'outline': 0.05,
+    'globals': 0.1,
+    'parse': 0.3,
+    'builtins': 0.2,
+    'namespaces': 0.1,
+}
+
+SCOPES = {
+    'complete': 'complete',
+    'members': 'members',
+}
+
+
+class FakeServer(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.documents = {}
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def write(self, line):
+        with self.lock:
+            if self.options.framed:
+                # Same framing as BooHints.protocol, a 32 bit length prefix
+                data = line.encode('utf-8')
+                out = getattr(sys.stdout, 'buffer', sys.stdout)
+                out.write(struct.pack('>I', len(data)) + data)
+                out.flush()
+            else:
+                sys.stdout.write(line + '\n')
+                sys.stdout.flush()
+
+    def write_pages(self, resp):
+        """ Split the hints of a response in pages with the framed protocol """
+        hints = resp['hints']
+        size = self.options.page_size
+        for start in range(0, max(len(hints), 1), size):
+            page = dict(resp, hints=hints[start:start + size])
+            page['more'] = start + size < len(hints)
+            self.write(json.dumps(page, separators=(',', ':')))
+
+    def hints(self, command):
+        padding = 'x' * self.options.hint_size
+        return [
+            {'name': '{0}{1}'.format(command, i), 'node': 'Method',
+             'full': 'Fake.{0}{1}'.format(command, i), 'type': 'System.Int32',
+             'info': padding}
+            for i in range(self.options.hints)
+        ]
+
+    def result(self, command):
+        latency = LATENCIES.get(command, 0.01) * self.options.latency_scale
+        latency *= random.uniform(1 - self.options.jitter, 1 + self.options.jitter)
+        time.sleep(max(0, latency))
+
+        if command == 'parse':
+            return {'errors': [], 'warnings': []}
+        return {'scope': SCOPES.get(command, command), 'hints': self.hints(command)}
+
+    def respond(self, query):
+        command = query.get('command')
+        if command == 'batch' and not self.options.no_batch:
+            resp = {'results': [self.result(q.get('command')) for q in query.get('queries', [])]}
+        else:
+            resp = self.result(command)
+        if not self.options.no_ids and 'id' in query:
+            resp['id'] = query['id']
+        if self.options.framed and self.options.page_size and 'hints' in resp:
+            self.write_pages(resp)
+        else:
+            self.write(json.dumps(resp, separators=(',', ':')))
+
+    def handle(self, query):
+        command = query.get('command')
+        fname = query.get('fname')
+        if command == 'open':
+            self.documents[fname] = query.get('code', '')
+            return
+        if command == 'change':
+            text = self.documents.get(fname, '')
+            self.documents[fname] = text[:query['start']] + query['text'] + text[query['end']:]
+            return
+        if command == 'close':
+            self.documents.pop(fname, None)
+            return
+
+        self.queries += 1
+        every = self.options.reference_modified
+        if every and self.queries % every == 0:
+            self.write('#!ReferenceModified: Fake.dll')
+
+        if self.options.no_ids:
+            # A server without ids must answer in order
+            self.respond(query)
+        else:
+            thread = threading.Thread(target=self.respond, args=(query,))
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        self.write('# Fake hint server ready')
+        for line in iter(sys.stdin.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+            if line == 'quit':
+                break
+            try:
+                self.handle(json.loads(line))
+            except ValueError as ex:
+                sys.stderr.write('Invalid query: {0}\n'.format(ex))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help='multiplier for the typical latencies')
+    parser.add_argument('--jitter', type=float, default=0.3,
+                        help='random variation of the latencies as a fraction')
+    parser.add_argument('--hints', type=int, default=50,
+                        help='number of hints in each response')
+    parser.add_argument('--hint-size', type=int, default=40,
+                        help='padding characters in each hint')
+    parser.add_argument('--reference-modified', type=int, default=0,
+                        help='report modified references every N queries')
+    parser.add_argument('--no-ids', action='store_true',
+                        help='do not echo the query ids, forcing serialized queries')
+    parser.add_argument('--no-batch', action='store_true',
+                        help='do not support batches of queries')
+    parser.add_argument('-framed', dest='framed', action='store_true',
+                        help='prefix the responses with their length')
+    parser.add_argument('--page-size', type=int, default=0,
+                        help='hints in each page of the framed responses')
+    # Arguments from the rsp file are accepted and ignored
+    options, _ = parser.parse_known_args(argv)
+    FakeServer(options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Replays a session recorded with the `record` option of the servers,
+comparing the latencies with the recorded ones.
+
+    python -m BooHints.bench.replay session.log.gz --speed 4
+    python -m BooHints.bench.replay session.log.gz --server "mono boohints.exe"
+"""
+
+import sys
+import shlex
+import logging
+import argparse
+
+from ..server import Server
+from ..recorder import Replayer
+from . import FAKESERVER
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m BooHints.bench.replay',
+                                     description='Replay a recorded hint server session.')
+    parser.add_argument('log', help='log file written by the recorder')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay this times faster than recorded')
+    parser.add_argument('--server', default=None,
+                        help='command line of the server, the fake one by default')
+    parser.add_argument('--sync-documents', action='store_true',
+                        help='send document changes instead of the whole code')
+    parser.add_argument('--verbose', action='store_true')
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.WARNING)
+
+    args = shlex.split(options.server) if options.server else [sys.executable, FAKESERVER]
+    # Every replayed query must reach the server
+    server = Server(args[0], args[1:], sync_documents=options.sync_documents,
+                    cache=False, prefetch=())
+    try:
+        print(Replayer(options.log).run(server, options.speed))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
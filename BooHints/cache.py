@@ -0,0 +1,140 @@
+"""
+Caches for the responses obtained from the hints server.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('boo.cache')
+
+
+class ResponseCache(object):
+    """ LRU cache of raw response lines, bounded both by the number of
+        entries and by their total size in characters. Keeping the raw line
+        instead of the decoded response gives each hit a fresh copy which the
+        caller is free to modify.
+    """
+
+    def __init__(self, size=256, memory=16 * 1024 * 1024):
+        self.size = size
+        self.memory = memory
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            line = self.entries.pop(key, None)
+            if line is None:
+                self.misses += 1
+                return None
+            # Re-insert it to mark it as the most recently used
+            self.entries[key] = line
+            self.hits += 1
+            return line
+
+    def put(self, key, line):
+        if len(line) > self.memory:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.used -= len(old)
+
+            self.entries[key] = line
+            self.used += len(line)
+
+            # Evict the least recently used entries
+            while len(self.entries) > self.size or self.used > self.memory:
+                _, old = self.entries.popitem(last=False)
+                self.used -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+
+class DiskCache(object):
+    """ Persists hints not depending on any document (builtins, namespaces,
+        members of a type...) so they are available right after a restart.
+
+        Each server configuration gets its own file, named after a hash of
+        its command line and the modification time and size of every
+        referenced assembly, so rebuilding any of them invalidates it.
+    """
+
+    def __init__(self, directory, args, cwd=None):
+        self.path = os.path.join(directory, self.key(args, cwd) + '.json')
+        self.lock = threading.Lock()
+        self.data = None
+
+    @staticmethod
+    def key(args, cwd=None):
+        references = []
+        for arg in args:
+            if not arg.startswith('-r'):
+                continue
+            ref = arg.split(':', 1)[-1]
+            try:
+                st = os.stat(os.path.join(cwd or '.', ref))
+                references.append((ref, st.st_mtime, st.st_size))
+            except OSError:
+                # Probably an assembly from the GAC
+                references.append((ref, None, None))
+
+        data = json.dumps([list(args), references]).encode('utf-8')
+        return hashlib.sha1(data).hexdigest()
+
+    def load(self):
+        if self.data is not None:
+            return self.data
+
+        try:
+            with open(self.path) as fp:
+                self.data = json.load(fp)
+            logger.debug('Loaded hints cache %s', self.path)
+        except (IOError, OSError, ValueError):
+            self.data = {}
+        return self.data
+
+    def get(self, name):
+        with self.lock:
+            return self.load().get(name)
+
+    def put(self, name, hints):
+        with self.lock:
+            data = self.load()
+            data[name] = hints
+
+            # Write to a temporary file first to never leave it half written
+            tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            try:
+                if not os.path.isdir(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                with open(tmp, 'w') as fp:
+                    json.dump(data, fp, separators=(',', ':'))
+                replace(tmp, self.path)
+            except (IOError, OSError) as ex:
+                logger.error('Unable to write hints cache %s: %s', self.path, ex)
+
+
+def replace(src, dst):
+    """ Atomically rename a file overwriting the destination """
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
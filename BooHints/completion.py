@@ -0,0 +1,49 @@
+"""
+Narrows the completions locally while the word being completed grows, so
+the hints server is only asked again when the context changes.
+"""
+
+import logging
+
+logger = logging.getLogger('boo.completion')
+
+
+def fuzzy_match(prefix, name):
+    """ Check if the characters of the prefix appear in order in the name,
+        ignoring case. Editors match completions this way, so `wln` finds
+        `WriteLine`. Both are expected in lower case.
+    """
+    chars = iter(name)
+    return all(c in chars for c in prefix)
+
+
+class CompletionSession(object):
+    """ Completions obtained for a start point together with the context
+        they are valid for. While the context stays the same they are
+        narrowed with the typed prefix instead of querying them again.
+
+        The context is whatever the caller needs to compare, usually the
+        start point, the scope there and a summary of the rest of the
+        buffer.
+    """
+
+    def __init__(self, context, items, key=lambda x: x['name']):
+        self.context = context
+        self.items = items
+        # Names are compared in lower case, converted once
+        self.names = [key(x).lower() for x in items]
+
+    def matches(self, context):
+        return self.context == context
+
+    def narrow(self, prefix):
+        """ Items matching the prefix in their original order, never leaving
+            out any the editor would offer for it.
+        """
+        if not prefix:
+            return list(self.items)
+        prefix = prefix.lower()
+        items = [x for x, name in zip(self.items, self.names) if fuzzy_match(prefix, name)]
+        logger.debug('Narrowed %d completions to %d for "%s"',
+                     len(self.items), len(items), prefix)
+        return items
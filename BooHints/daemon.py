@@ -0,0 +1,518 @@
+"""
+Long lived process owning the hint servers on behalf of several clients, so
+every editor instance or tool running as the same user shares the warm
+compilers instead of paying the cold start and memory of its own.
+
+Clients connect to a Unix domain socket and attach to the process for a
+command line sending a first line like:
+
+    {"command": "attach", "args": ["mono", "boohints.exe", ...], "cwd": "...", "slot": 0,
+     "replace": 1234}
+
+The daemon answers with `{"pid": 1234}`, or `{"error": "..."}`, and from
+then on the connection speaks the usual protocol. A process reporting its
+references were modified, or the one a client asks to `replace` since it
+restarted it, is replaced with a fresh one for the next clients attaching.
+It is stopped once its last client detaches. Query ids are rewritten
+so the responses reach the right client, and the documents synchronized by
+each one are tracked so the process always compiles the contents of the
+client asking.
+
+    python -m BooHints.daemon --socket ~/.boohints.sock --idle 1800
+"""
+
+import os
+import sys
+import json
+import socket
+import signal
+import logging
+import argparse
+import tempfile
+import threading
+import itertools
+import collections
+# Work around Python 3 module renames
+try:
+    import queue
+except:
+    import Queue as queue
+
+from .reactor import REACTOR, TIMERS
+from .server import PipeTransport, encode_query
+from .protocol import FRAMED_ARG, FrameDecoder, FrameError, encode_frame
+
+logger = logging.getLogger('boo.daemon')
+
+# Commands synchronizing the documents, they get no response
+DOCUMENT_COMMANDS = ('open', 'change', 'close')
+
+
+def default_socket():
+    """ Path of the socket for the current user, inside its runtime
+        directory or otherwise a private directory in the temp one.
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        return os.path.join(runtime, 'boohints.sock')
+    dirname = os.path.join(tempfile.gettempdir(), 'boohints-{0}'.format(os.getuid()))
+    return os.path.join(dirname, 'boohints.sock')
+
+
+def private_dir(dirname):
+    """ Create the directory only accessible by the current user, refusing
+        to use an existing one which another user could tamper with.
+    """
+    try:
+        os.mkdir(dirname, 0o700)
+    except OSError:
+        if not os.path.isdir(dirname):
+            raise
+    info = os.lstat(dirname)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise IOError('Directory {0} is not private to the current user'.format(dirname))
+
+
+def encode_response(resp):
+    return json.dumps(resp, separators=(',', ':')).encode('utf-8')
+
+
+class Client(object):
+    """ Connection of a client, attached to a backend with its first line """
+
+    def __init__(self, daemon, sock):
+        self.daemon = daemon
+        self.sock = sock
+        self.reader = sock.makefile('rb', 0)
+        self.backend = None
+        self.framed = False
+        self.closed = False
+        self.lock = threading.Lock()
+        # Version and contents of the documents synchronized by the client
+        self.documents = {}
+
+        # A client not reading its responses must never block the reactor,
+        # which serves every backend and client.
+        self.outgoing = queue.Queue()
+        writer = threading.Thread(target=self.thread_writer)
+        writer.daemon = True
+        writer.start()
+
+    def on_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        if line == b'quit':
+            self.close()
+            return
+        try:
+            query = json.loads(line.decode('utf-8'))
+        except ValueError as ex:
+            logger.warning('Invalid query from client: %s', ex)
+            return
+
+        if self.backend is None:
+            self.daemon.attach(self, query)
+        elif isinstance(query, dict):
+            self.backend.forward(self, query)
+
+    def send(self, payload):
+        """ Write a message, framed when the client expects it """
+        data = encode_frame(payload) if self.framed else payload + b'\n'
+        with self.lock:
+            if not self.closed:
+                self.outgoing.put(data)
+
+    def close(self):
+        """ Hang up once the messages sent so far are written, the reactor
+            then reports the connection as closed.
+        """
+        with self.lock:
+            if not self.closed:
+                self.outgoing.put(None)
+
+    def thread_writer(self):
+        while True:
+            data = self.outgoing.get()
+            if data is None:
+                break
+            try:
+                self.sock.sendall(data)
+            except (IOError, OSError) as ex:
+                logger.debug('Unable to write to client: %s', ex)
+                break
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+
+    def on_close(self):
+        with self.lock:
+            self.closed = True
+            self.outgoing.put(None)
+        if self.backend is not None:
+            self.backend.detach(self)
+        self.sock.close()
+
+
+class Backend(object):
+    """ Server process shared by the clients attached to its command line """
+
+    def __init__(self, daemon, key):
+        args, cwd, slot = key
+        self.daemon = daemon
+        self.key = key
+        self.transport = PipeTransport(list(args), cwd)
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.stopped = False
+        # References were modified, the next clients get a fresh process
+        self.stale = False
+        # Replaced by a fresh process, stopped without clients
+        self.retired = False
+        self._ids = itertools.count(1)
+        # Queries waiting for a response by their id in the process, and in
+        # the order they were issued for servers not echoing the ids. Each
+        # route is [client, client id, id, answered].
+        self.routes = {}
+        self.order = collections.deque()
+        # Client whose contents of each document the process has
+        self.owners = {}
+        self.idle_timer = None
+
+        # Writes to the process never block the reactor, which must keep
+        # reading its responses.
+        self.outgoing = queue.Queue()
+        writer = threading.Thread(target=self.thread_writer)
+        writer.daemon = True
+        writer.start()
+
+        transport = self.transport
+        if FRAMED_ARG in args:
+            decoder = FrameDecoder()
+            REACTOR.add_reader(transport.reader, lambda data: self.on_frames(decoder, data),
+                               self.on_exit, raw=True)
+        else:
+            REACTOR.add_reader(transport.reader, self.on_response, self.on_exit)
+        REACTOR.add_reader(transport.errors, self.on_stderr)
+
+        logger.info('Started hint server with PID %s using: %s',
+                    transport.pid, ' '.join(args))
+
+    def is_alive(self):
+        return not self.stopped and self.transport.poll() is None
+
+    def add(self, client):
+        with self.lock:
+            self.clients.add(client)
+            client.backend = self
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+
+    def detach(self, client):
+        """ Forget about a client, closing the documents it synchronized """
+        with self.lock:
+            self.clients.discard(client)
+            for fname, owner in list(self.owners.items()):
+                if owner is client:
+                    del self.owners[fname]
+                    self.write({'command': 'close', 'fname': fname})
+            if not self.clients and not self.stopped:
+                delay = 0 if self.retired else self.daemon.idle
+                self.idle_timer = TIMERS.call_later(delay, self.check_idle)
+
+    def retire(self):
+        """ Stop once the clients still attached detach """
+        with self.lock:
+            self.retired = True
+            if self.clients or self.stopped:
+                return
+        self.stop()
+
+    def check_idle(self):
+        with self.lock:
+            if self.clients or self.stopped:
+                return
+        logger.info('Stopping hint server %s without clients', self.transport.pid)
+        self.daemon.remove(self)
+        self.stop()
+
+    def forward(self, client, query):
+        """ Send a query from a client to the process """
+        command = query.get('command')
+        fname = query.get('fname')
+        with self.lock:
+            if command in DOCUMENT_COMMANDS:
+                self.sync(client, command, fname, query)
+                return
+
+            # Another client may have sent its own contents in the meantime
+            if fname in client.documents and self.owners.get(fname) is not client:
+                self.reopen(client, fname)
+
+            qid = next(self._ids)
+            route = [client, query.get('id'), qid, False]
+            self.routes[qid] = route
+            self.order.append(route)
+            query['id'] = qid
+            self.write(query)
+
+    def sync(self, client, command, fname, query):
+        """ Track the documents of each client, the process gets the whole
+            contents when switching to a different client.
+        """
+        if command == 'close':
+            client.documents.pop(fname, None)
+            if self.owners.get(fname) is client:
+                del self.owners[fname]
+                self.write(query)
+            return
+
+        if command == 'open':
+            text = query.get('code', '')
+        else:
+            text = client.documents.get(fname, (None, ''))[1]
+            text = text[:query['start']] + query['text'] + text[query['end']:]
+        client.documents[fname] = (query.get('version'), text)
+
+        if command == 'change' and self.owners.get(fname) is client:
+            self.write(query)
+        else:
+            self.reopen(client, fname)
+
+    def reopen(self, client, fname):
+        version, text = client.documents[fname]
+        self.write({'command': 'open', 'fname': fname, 'version': version, 'code': text})
+        self.owners[fname] = client
+
+    def write(self, query):
+        self.outgoing.put(encode_query(query))
+
+    def thread_writer(self):
+        while True:
+            data = self.outgoing.get()
+            if data is None:
+                break
+            try:
+                self.transport.write(data)
+            except (IOError, OSError) as ex:
+                logger.warning('Unable to write to hint server %s: %s', self.transport.pid, ex)
+
+    def on_frames(self, decoder, data):
+        try:
+            for payload in decoder.feed(data):
+                self.on_response(payload)
+        except FrameError as ex:
+            # Out of sync with the process, clients respawn it attaching again
+            logger.error('Invalid data from hint server %s: %s', self.transport.pid, ex)
+            self.daemon.remove(self)
+            self.stop()
+
+    def on_response(self, line):
+        """ Route a message from the process to the client waiting for it """
+        line = line.strip()
+        if not line:
+            return
+        if line.startswith(b'#!'):
+            # Server commands concern every client
+            with self.lock:
+                if line.startswith(b'#!ReferenceModified'):
+                    self.stale = True
+                clients = list(self.clients)
+            for client in clients:
+                client.send(line)
+            return
+        if line.startswith(b'#'):
+            logger.debug('Server %s: %s', self.transport.pid, line[1:].decode('utf-8'))
+            return
+
+        try:
+            resp = json.loads(line.decode('utf-8'))
+        except ValueError as ex:
+            logger.warning('Invalid response from hint server: %s', ex)
+            return
+        tagged = isinstance(resp, dict) and 'id' in resp
+
+        with self.lock:
+            if tagged:
+                route = self.routes.get(resp['id'])
+            else:
+                # Servers without ids answer in order
+                route = self.order[0] if self.order else None
+            if route is None:
+                logger.debug('Dropping response without query: %s', line[:100])
+                return
+
+            # Pages of a response are routed until the last one
+            if not (isinstance(resp, dict) and resp.get('more')):
+                route[3] = True
+                self.routes.pop(route[2], None)
+                while self.order and self.order[0][3]:
+                    self.order.popleft()
+
+        client, cid = route[0], route[1]
+        if tagged:
+            if cid is None:
+                del resp['id']
+            else:
+                resp['id'] = cid
+            line = encode_response(resp)
+        client.send(line)
+
+    def on_stderr(self, line):
+        line = line.decode('utf-8').rstrip()
+        if line:
+            logger.error('Server %s: %s', self.transport.pid, line)
+
+    def on_exit(self):
+        """ The process died, clients respawn it attaching again """
+        if self.stopped:
+            return
+        logger.warning('Hint server process %s exited with code %s',
+                       self.transport.pid, self.transport.poll())
+        self.daemon.remove(self)
+        self.stop()
+
+    def stop(self):
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            clients = list(self.clients)
+        REACTOR.remove_reader(self.transport.reader)
+        REACTOR.remove_reader(self.transport.errors)
+        self.outgoing.put(None)
+        self.transport.close()
+        for client in clients:
+            client.close()
+
+
+class Daemon(object):
+    """ Accepts clients on a Unix socket, attaching them to a backend for
+        their command line. Backends without clients are stopped after
+        `idle` seconds.
+
+        Only the user running it may connect, since clients choose the
+        command line to run.
+    """
+
+    def __init__(self, path=None, idle=1800):
+        self.path = path or default_socket()
+        self.idle = idle
+        self.backends = {}
+        self.lock = threading.Lock()
+        self.sock = None
+
+    def listen(self):
+        # The default location outside of the runtime directory is created
+        # private, a custom one is up to the user.
+        if self.path == default_socket():
+            dirname = os.path.dirname(self.path)
+            if dirname != os.environ.get('XDG_RUNTIME_DIR'):
+                private_dir(dirname)
+
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except (IOError, OSError):
+                # Left behind by a daemon which did not exit cleanly
+                os.unlink(self.path)
+            else:
+                raise IOError('A daemon is already listening on ' + self.path)
+            finally:
+                probe.close()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(16)
+        logger.info('Listening on %s', self.path)
+
+    def serve_forever(self):
+        if self.sock is None:
+            self.listen()
+        while True:
+            conn, _ = self.sock.accept()
+            client = Client(self, conn)
+            REACTOR.add_reader(client.reader, client.on_line, client.on_close)
+
+    def attach(self, client, query):
+        args = query.get('args') if isinstance(query, dict) else None
+        if not args or query.get('command') != 'attach':
+            client.send(encode_response({'error': 'Expected an attach command'}))
+            client.close()
+            return
+
+        key = (tuple(args), query.get('cwd'), query.get('slot', 0))
+        with self.lock:
+            backend = self.backends.get(key)
+            if backend is not None and (backend.stale or
+                                        backend.transport.pid == query.get('replace')):
+                logger.info('Replacing hint server %s', backend.transport.pid)
+                del self.backends[key]
+                backend.retire()
+                backend = None
+            if backend is None or not backend.is_alive():
+                try:
+                    backend = self.backends[key] = Backend(self, key)
+                except (IOError, OSError) as ex:
+                    logger.error('Unable to start hint server: %s', ex)
+                    client.send(encode_response({'error': str(ex)}))
+                    client.close()
+                    return
+
+            # The handshake is always a line, the protocol may be framed later
+            client.send(encode_response({'pid': backend.transport.pid}))
+            client.framed = FRAMED_ARG in args
+            backend.add(client)
+
+    def remove(self, backend):
+        with self.lock:
+            if self.backends.get(backend.key) is backend:
+                del self.backends[backend.key]
+
+    def shutdown(self):
+        with self.lock:
+            backends = list(self.backends.values())
+            self.backends.clear()
+        for backend in backends:
+            backend.stop()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m BooHints.daemon',
+                                     description='Share the hint servers among clients.')
+    parser.add_argument('--socket', default=None,
+                        help='path of the Unix socket, {0} by default'.format(default_socket()))
+    parser.add_argument('--idle', type=float, default=1800,
+                        help='seconds to keep a server without clients')
+    parser.add_argument('--verbose', action='store_true')
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO)
+
+    daemon = Daemon(options.socket, options.idle)
+    # Clean up the socket when terminated too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Balances the queries for a project among several hint server processes.
+"""
+
+import logging
+import threading
+
+from .server import Server
+from .cache import ResponseCache
+from .stats import AdaptiveTimeouts
+
+logger = logging.getLogger('boo.pool')
+
+# Commands which may keep a compiler busy for a long time
+HEAVY_COMMANDS = ('parse', 'globals', 'outline', 'builtins', 'namespaces')
+
+
+class ServerPool(object):
+    """ Group of servers sharing the same configuration. Heavy commands are
+        routed to a dedicated worker so they never delay the interactive ones
+        (complete, entity, locals...), which go to the least loaded of the
+        remaining workers.
+    """
+
+    def __init__(self, bin, args=None, rsp=None, cwd=None, workers=1, **kwargs):
+        # Configuration to create a replacement pool
+        self.config = (bin, list(args or []), rsp, cwd, workers, dict(kwargs))
+        # Called with the pool when the references change, otherwise each
+        # worker restarts its process.
+        self.on_stale = None
+        self.swapping = False
+        # Routing and queueing a keyed async query happen together
+        self.lock = threading.Lock()
+        # All the workers share the same response cache
+        if kwargs.get('cache') is None:
+            kwargs['cache'] = ResponseCache()
+        # And learn the timeouts together
+        if not isinstance(kwargs.get('timeouts'), AdaptiveTimeouts):
+            kwargs['timeouts'] = AdaptiveTimeouts(**(kwargs.get('timeouts') or {}))
+        self.workers = [
+            Server(bin, list(args or []), rsp=rsp, cwd=cwd, **kwargs)
+            for _ in range(max(1, workers))
+        ]
+        # Only the first worker needs to fetch the shared hints
+        for worker in self.workers[1:]:
+            worker.prefetch = ()
+        for slot, worker in enumerate(self.workers):
+            worker.on_stale = self.stale
+            # Each worker gets its own process when attached to the daemon
+            worker.slot = slot
+
+    def select(self, command):
+        """ Choose the worker which should run the given command
+        """
+        if len(self.workers) == 1 or command in HEAVY_COMMANDS:
+            return self.workers[0]
+
+        return min(self.workers[1:], key=lambda x: x.load())
+
+    def is_alive(self):
+        return any(x.is_alive() for x in self.workers)
+
+    def is_busy(self):
+        return any(x.is_busy() for x in self.workers)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def reset(self):
+        for worker in self.workers:
+            worker.reset()
+
+    def stale(self, worker=None):
+        """ Notified by a worker, or any worker if not given, when the
+            references changed.
+        """
+        if self.on_stale is None:
+            for worker in [worker] if worker else self.workers:
+                worker.schedule_restart()
+        elif not self.swapping:
+            self.swapping = True
+            self.on_stale(self)
+
+    def invalidate(self):
+        for worker in self.workers:
+            worker.invalidate()
+
+    def clone(self):
+        """ Create a pool with the same configuration and documents """
+        bin, args, rsp, cwd, workers, kwargs = self.config
+        # Latencies are still meaningful for the new processes
+        kwargs = dict(kwargs, timeouts=self.workers[0].timeouts)
+        pool = ServerPool(bin, args, rsp=rsp, cwd=cwd, workers=workers, **kwargs)
+        for worker, stale in zip(pool.workers, self.workers):
+            worker.documents = dict(self.workers[0].documents)
+            # Never attach again to the stale process of the daemon
+            worker.replaces = stale.pid()
+        return pool
+
+    def warm(self):
+        for worker in self.workers:
+            worker.warm()
+
+    def retire(self):
+        for worker in self.workers:
+            worker.retire()
+
+    def query(self, command, **kwargs):
+        return self.select(command).query(command, **kwargs)
+
+    def route(self, worker, key):
+        """ A query with a key goes to the worker already holding a pending
+            one with the same key, so it gets replaced there instead of both
+            running in different workers.
+        """
+        if key is not None:
+            for x in self.workers:
+                if key in x.async_queries:
+                    return x
+        return worker
+
+    def query_async(self, callback, command, key=None, **kwargs):
+        with self.lock:
+            worker = self.route(self.select(command), key)
+            worker.query_async(callback, command, key=key, **kwargs)
+
+    def select_batch(self, queries):
+        """ A batch runs in the heavy worker if any of its commands is heavy """
+        commands = [q['command'] for q in queries]
+        if any(x in HEAVY_COMMANDS for x in commands):
+            return self.workers[0]
+        return self.select(commands[0])
+
+    def query_batch(self, queries, **kwargs):
+        return self.select_batch(queries).query_batch(queries, **kwargs)
+
+    def query_batch_async(self, callback, queries, key=None, **kwargs):
+        with self.lock:
+            worker = self.route(self.select_batch(queries), key)
+            worker.query_batch_async(callback, queries, key=key, **kwargs)
+
+    def builtins(self, block=False):
+        return self.workers[0].builtins(block)
+
+    def namespaces(self, block=False):
+        return self.workers[0].namespaces(block)
+
+    def type_members(self, fullname, block=False):
+        return self.workers[0].type_members(fullname, block)
+
+    def update_document(self, fname, version, text):
+        if callable(text):
+            doc = self.workers[0].documents.get(fname)
+            if doc is not None and doc.version == version:
+                return
+            text = text()
+        for worker in self.workers:
+            worker.update_document(fname, version, text)
+
+    def close_document(self, fname):
+        for worker in self.workers:
+            worker.close_document(fname)
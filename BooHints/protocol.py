@@ -0,0 +1,50 @@
+"""
+Framed variant of the hints protocol. Instead of one JSON line per message
+the server prefixes each one with its length as a 32 bit big endian
+integer, and long lists of hints are split in pages sent as separate
+messages, flagged with `"more": true` until the last one.
+
+Pages are decoded as they arrive so the first hints can be used before the
+whole list is received, and a huge response never needs to be buffered as
+a single line. Queries are still sent as JSON lines.
+"""
+
+import struct
+
+# Argument making the server use the framed protocol
+FRAMED_ARG = '-framed'
+
+HEADER = struct.Struct('>I')
+
+
+def encode_frame(payload):
+    """ Prefix a message with its length """
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameError(ValueError):
+    """ The data read is not a valid frame, the stream can not be resumed """
+
+
+class FrameDecoder(object):
+    """ Splits the data read from the server into messages """
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """ Consume some data yielding every message completed with it """
+        self.buffer.extend(data)
+        while len(self.buffer) >= HEADER.size:
+            size, = HEADER.unpack_from(bytes(self.buffer[:HEADER.size]))
+            if size > self.max_size:
+                # Nothing after it can be trusted, keep the memory bounded
+                del self.buffer[:]
+                raise FrameError('Frame of {0} bytes exceeds the limit'.format(size))
+            end = HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[HEADER.size:end])
+            del self.buffer[:end]
+            yield payload
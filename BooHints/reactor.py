@@ -0,0 +1,361 @@
+"""
+Shared I/O loop and worker threads serving every hint server.
+
+Instead of dedicating a set of threads to each server, the output pipes of
+all the spawned processes are watched by a single thread waiting on them
+with `select`, async queries are run by a fixed number of workers and
+delayed calls share a single timer thread.
+"""
+
+import os
+import time
+import select
+import threading
+import logging
+import heapq
+import itertools
+import collections
+
+logger = logging.getLogger('boo.reactor')
+
+# Windows is unable to wait for pipes with select
+SELECTABLE_PIPES = os.name != 'nt'
+
+
+class Reactor(object):
+    """ Reads lines from the registered pipes as soon as data is available,
+        handing them to the callback associated with each one. Nothing is
+        polled, when no pipes are registered the thread just sleeps.
+
+        Callbacks run in the reactor thread so they must never block.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.readers = {}
+        self.thread = None
+        if SELECTABLE_PIPES:
+            self._wakeup = os.pipe()
+
+    def add_reader(self, fileobj, on_line, on_close=None, raw=False):
+        """ Watch the pipe reporting each line read from it (without the line
+            ending) and optionally when it gets closed. When `raw` the data is
+            reported as it is read instead.
+        """
+        reader = _Reader(fileobj, on_line, on_close, raw)
+
+        if not SELECTABLE_PIPES:
+            threading.Thread(target=self.thread_reader, args=(reader,)).start()
+            return
+
+        with self.lock:
+            self.readers[reader.fd] = reader
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.thread_select)
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup()
+
+    def remove_reader(self, fileobj):
+        """ Stop watching the pipe, its close callback will not be called.
+        """
+        if not SELECTABLE_PIPES:
+            # The reader thread exits once the pipe is closed
+            return
+
+        with self.lock:
+            reader = self.readers.pop(fileobj.fileno(), None)
+        if reader:
+            reader.closed = True
+            self.wakeup()
+
+    def wakeup(self):
+        """ Interrupt the select call so it picks up the new set of pipes """
+        os.write(self._wakeup[1], b'.')
+
+    def thread_select(self):
+        """ Thread waiting for data on every registered pipe """
+        while True:
+            with self.lock:
+                readers = list(self.readers.values())
+
+            fds = [x.fd for x in readers] + [self._wakeup[0]]
+            try:
+                ready, _, _ = select.select(fds, [], [])
+            except (select.error, OSError, ValueError) as ex:
+                logger.error('Error waiting for pipes: %s', ex)
+                self.prune()
+                continue
+
+            if self._wakeup[0] in ready:
+                os.read(self._wakeup[0], 512)
+
+            for reader in readers:
+                if reader.fd in ready and not reader.closed:
+                    if not reader.read():
+                        with self.lock:
+                            self.readers.pop(reader.fd, None)
+                        reader.close()
+
+    def thread_reader(self, reader):
+        """ Fallback thread blocking on a single pipe """
+        while reader.read():
+            pass
+        reader.close()
+
+    def prune(self):
+        """ Remove pipes which were closed without unregistering them """
+        with self.lock:
+            for fd, reader in list(self.readers.items()):
+                if reader.fileobj.closed:
+                    del self.readers[fd]
+
+
+class _Reader(object):
+    """ Buffers the data read from a pipe until full lines are available """
+
+    def __init__(self, fileobj, on_line, on_close, raw=False):
+        self.fileobj = fileobj
+        self.fd = fileobj.fileno()
+        self.on_line = on_line
+        self.on_close = on_close
+        self.raw = raw
+        self.closed = False
+        self.buffer = b''
+
+    def read(self):
+        """ Consume the available data, returns False once the pipe is closed
+        """
+        try:
+            if SELECTABLE_PIPES:
+                data = os.read(self.fd, 65536)
+            else:
+                data = self.fileobj.readline()
+        except (IOError, OSError):
+            data = b''
+
+        if not data:
+            return False
+
+        if self.raw:
+            lines = [data]
+        else:
+            lines = (self.buffer + data).split(b'\n')
+            self.buffer = lines.pop()
+        for line in lines:
+            try:
+                self.on_line(line)
+            except Exception as ex:
+                logger.error(str(ex), exc_info=True)
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.buffer:
+            self.on_line(self.buffer)
+            self.buffer = b''
+        if self.on_close:
+            self.on_close()
+
+
+class TimerWheel(object):
+    """ Runs delayed calls from a single thread, instead of spawning a
+        `threading.Timer` for each one. Callbacks must be quick.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.timers = []
+        self.thread = None
+        self._seq = itertools.count()
+
+    def call_later(self, delay, callback):
+        """ Schedule a call returning a handle which allows to cancel it """
+        timer = _Timer(time.time() + delay, callback)
+        with self.cond:
+            heapq.heappush(self.timers, (timer.deadline, next(self._seq), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.thread_timers)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        return timer
+
+    def thread_timers(self):
+        """ Thread waiting for the next deadline """
+        while True:
+            with self.cond:
+                while not self.timers:
+                    self.cond.wait()
+                deadline, _, timer = self.timers[0]
+                delay = deadline - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                heapq.heappop(self.timers)
+
+            if not timer.cancelled:
+                try:
+                    timer.callback()
+                except Exception as ex:
+                    logger.error(str(ex), exc_info=True)
+
+
+class _Timer(object):
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Dispatcher(object):
+    """ Threads running the async queries of all the servers. A server is
+        handled by a single thread at a time, so its queries are still run
+        in the order they were issued.
+
+        Threads are started on demand, whenever a server has work and every
+        thread is busy with another one, so a slow query never delays the
+        other servers. Up to `threads` are kept once started, the rest exit
+        after `idle` seconds without work.
+    """
+
+    def __init__(self, threads=2, idle=30.0):
+        self.threads = threads
+        self.idle = idle
+        self.ready = collections.deque()
+        self.cond = threading.Condition()
+        self.workers = 0
+        self.waiting = 0
+
+    def schedule(self, server):
+        """ Notify that the server has async work ready to be run with its
+            `run_async` method.
+        """
+        with self.cond:
+            self.ready.append(server)
+            if self.waiting >= len(self.ready):
+                self.cond.notify()
+                return
+            self.workers += 1
+            thread = threading.Thread(target=self.thread_worker,
+                                      args=(self.workers <= self.threads,))
+            thread.daemon = True
+            thread.start()
+
+    def thread_worker(self, permanent):
+        """ Thread to perform async queries """
+        while True:
+            with self.cond:
+                self.waiting += 1
+                deadline = time.time() + self.idle
+                while not self.ready:
+                    remaining = deadline - time.time()
+                    if not permanent and remaining <= 0:
+                        self.waiting -= 1
+                        self.workers -= 1
+                        return
+                    self.cond.wait(None if permanent else remaining)
+                self.waiting -= 1
+                server = self.ready.popleft()
+
+            try:
+                server.run_async()
+            except Exception as ex:
+                logger.error(str(ex), exc_info=True)
+
+
+class Mailbox(object):
+    """ Queue of async work for a single server. Makes sure the server is
+        scheduled in the dispatcher only once while it has pending work.
+
+        Items are taken by priority (lower values first) and then in order of
+        arrival. To avoid starvation an item gains one priority level for each
+        `aging` seconds it has been waiting.
+
+        Items put with a key replace any pending one with the same key,
+        keeping its position in the queue, so superseded work is never run.
+    """
+
+    def __init__(self, dispatcher, server, aging=1.0):
+        self.dispatcher = dispatcher
+        self.server = server
+        self.aging = aging
+        self.lock = threading.Lock()
+        self.items = {}
+        self.scheduled = False
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def put(self, item, key=None, priority=0):
+        with self.lock:
+            if key is None:
+                key = (Mailbox, next(self._seq))
+            entry = self.items.get(key)
+            if entry is None:
+                self.items[key] = [priority, time.time(), next(self._seq), item]
+            else:
+                logger.debug('Coalescing async query %s', key)
+                entry[0] = min(entry[0], priority)
+                entry[3] = item
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.dispatcher.schedule(self.server)
+
+    def get(self, limit=None):
+        """ Obtain the next item or None if empty. When a limit is given only
+            items with that priority or a more urgent one are considered.
+        """
+        with self.lock:
+            now = time.time()
+            best = None
+            for key, (priority, since, seq, item) in self.items.items():
+                priority -= (now - since) / self.aging
+                if limit is not None and priority > limit:
+                    continue
+                if best is None or (priority, seq) < best[:2]:
+                    best = (priority, seq, key)
+
+            if best is None:
+                return None
+            return self.items.pop(best[2])[3]
+
+    def done(self, idle=False):
+        """ Report that the last item was processed, scheduling the server
+            again if there is more work for it. When `idle` the server is not
+            scheduled until calling `resume`.
+        """
+        with self.lock:
+            self.scheduled = bool(self.items) and not idle
+            if not self.scheduled:
+                return
+        self.dispatcher.schedule(self.server)
+
+    def resume(self):
+        """ Schedule the server if there is work waiting for it """
+        with self.lock:
+            if self.scheduled or not self.items:
+                return
+            self.scheduled = True
+        self.dispatcher.schedule(self.server)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+REACTOR = Reactor()
+DISPATCHER = Dispatcher()
+TIMERS = TimerWheel()
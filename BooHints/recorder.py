@@ -0,0 +1,219 @@
+"""
+Records the traffic with the hint servers to a log file and replays it
+later, so the latency profile of a real editing session can be reproduced
+offline against other client or server builds.
+
+Each line of the log has the milliseconds elapsed since the recording
+started, the PID of the server process, the direction (`>` for data sent
+to the server, `<` for data received) and the protocol line, separated by
+tabs. Logs whose name ends with `.gz` are compressed.
+
+    python -m BooHints.bench.replay session.log.gz --speed 4
+"""
+
+import os
+import json
+import gzip
+import time
+import logging
+import threading
+import collections
+
+logger = logging.getLogger('boo.recorder')
+
+# Recorders by file name, servers recording to the same file share one
+_RECORDERS = {}
+_RECORDERS_LOCK = threading.Lock()
+
+
+def open_log(fname, mode):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode + 't')
+    return open(fname, mode)
+
+
+def get_recorder(fname):
+    """ Obtain the recorder writing to the given file """
+    fname = os.path.abspath(fname)
+    with _RECORDERS_LOCK:
+        if fname not in _RECORDERS:
+            _RECORDERS[fname] = Recorder(fname)
+        return _RECORDERS[fname]
+
+
+class Recorder(object):
+    """ Appends the protocol lines sent and received to a log file """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.started = time.time()
+        self.lock = threading.Lock()
+        dirname = os.path.dirname(fname)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.fp = open_log(fname, 'a')
+        self.fp.write('# Session started at {0}\n'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))))
+        logger.info('Recording hint server traffic to %s', fname)
+
+    def write(self, pid, direction, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        elapsed = (time.time() - self.started) * 1000
+        with self.lock:
+            if self.fp is None:
+                return
+            self.fp.write('{0:.1f}\t{1}\t{2}\t{3}\n'.format(
+                elapsed, pid, direction, line.rstrip('\r\n')))
+            self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+
+def read_log(fname):
+    """ Yields the (elapsed seconds, pid, direction, line) entries of a log """
+    with open_log(fname, 'r') as fp:
+        for ln in fp:
+            if ln.startswith('#'):
+                continue
+            parts = ln.rstrip('\r\n').split('\t', 3)
+            if len(parts) != 4:
+                continue
+            yield float(parts[0]) / 1000, parts[1], parts[2], parts[3]
+
+
+class Replayer(object):
+    """ Feeds the queries of a recorded session to a server, keeping their
+        original timing divided by `speed`, and compares the latencies
+        obtained with the recorded ones.
+    """
+
+    def __init__(self, fname):
+        self.queries = []
+        self.recorded = {}
+        self.replayed = {}
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.load(fname)
+
+    def load(self, fname):
+        """ Extract the queries and the latency they had when recorded,
+            matching the responses with their query by id. Untagged
+            responses belong to the oldest unanswered query of the process,
+            servers not echoing the ids answer in order.
+        """
+        sent = {}
+        # Unanswered queries of each process as [elapsed, command, answered]
+        unanswered = collections.defaultdict(collections.deque)
+        for elapsed, pid, direction, line in read_log(fname):
+            if line.startswith('#'):
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(data, dict):
+                continue
+
+            if direction == '>':
+                self.queries.append((elapsed, data))
+                # Document updates get no response
+                if data.get('command') in ('open', 'change', 'close'):
+                    continue
+                entry = [elapsed, data.get('command'), False]
+                unanswered[pid].append(entry)
+                if 'id' in data:
+                    sent[pid, data['id']] = entry
+                continue
+
+            # Only the last page completes a response
+            if data.get('more'):
+                continue
+            pending = unanswered[pid]
+            if 'id' in data:
+                entry = sent.pop((pid, data['id']), None)
+            else:
+                entry = pending[0] if pending else None
+            if entry is None:
+                continue
+
+            entry[2] = True
+            while pending and pending[0][2]:
+                pending.popleft()
+            started, command = entry[0], entry[1]
+            self.recorded.setdefault(command, []).append(elapsed - started)
+
+    def run(self, server, speed=1.0):
+        """ Replay the session against the server returning a report """
+        documents = {}
+        threads = []
+        started = time.time()
+        base = self.queries[0][0] if self.queries else 0
+
+        for elapsed, data in self.queries:
+            delay = started + (elapsed - base) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            data = dict(data)
+            command = data.pop('command', None)
+            data.pop('id', None)
+            fname = data.get('fname')
+
+            # Document updates are applied in order, the server decides how
+            # to send them to its process.
+            if command == 'open':
+                documents[fname] = data.get('code', '')
+                server.update_document(fname, data.get('version'), documents[fname])
+            elif command == 'change':
+                text = documents.get(fname, '')
+                documents[fname] = text[:data['start']] + data['text'] + text[data['end']:]
+                server.update_document(fname, data.get('version'), documents[fname])
+            elif command == 'close':
+                documents.pop(fname, None)
+                server.close_document(fname)
+            elif command:
+                thread = threading.Thread(target=self.query, args=(server, command, data))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return self.report(time.time() - started)
+
+    def query(self, server, command, kwargs):
+        started = time.time()
+        resp = server.query(command, **kwargs)
+        with self.lock:
+            if resp is None:
+                self.failed += 1
+            else:
+                self.replayed.setdefault(command, []).append(time.time() - started)
+
+    def report(self, elapsed):
+        def pct(samples, p):
+            if not samples:
+                return '-'
+            samples = sorted(samples)
+            return '{0:.1f}'.format(samples[int(round((len(samples) - 1) * p / 100.0))] * 1000)
+
+        row = '{0:<12} {1:>7} {2:>10} {3:>10} {4:>7} {5:>10} {6:>10}'
+        lines = [row.format('command', 'count', 'p50 ms', 'p95 ms', 'count', 'p50 ms', 'p95 ms'),
+                 row.format('', 'recorded', '', '', 'replayed', '', '')]
+        for command in sorted(set(self.recorded) | set(self.replayed)):
+            rec = self.recorded.get(command, [])
+            rep = self.replayed.get(command, [])
+            lines.append(row.format(
+                command, len(rec), pct(rec, 50), pct(rec, 95),
+                len(rep), pct(rep, 50), pct(rep, 95)))
+
+        lines.append('')
+        lines.append('Replayed {0} queries in {1:.1f} s, {2} failed'.format(
+            sum(len(x) for x in self.replayed.values()) + self.failed, elapsed, self.failed))
+        return '\n'.join(lines)
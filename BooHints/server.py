@@ -6,27 +6,291 @@ TODO: Silly parser for .booproj files if no rsp is found
 """
 
 import os
+import socket
+import struct
 import subprocess
 import threading
 import json
 import time
 import logging
+import itertools
+import hashlib
+import random
 # Work around Python 3 module renames
 try:
     import queue
 except:
     import Queue as queue
 
+from .reactor import REACTOR, DISPATCHER, TIMERS, Mailbox
+from .cache import ResponseCache, DiskCache
+from .stats import AdaptiveTimeouts, METRICS
+from .trace import TRACER
+from .recorder import get_recorder
+from .protocol import FRAMED_ARG, FrameDecoder, FrameError
+from .supervisor import SUPERVISOR
+
 logger = logging.getLogger('boo.server')
 
 
+# Priority classes for the async queries, lower values are run first
+INTERACTIVE, NAVIGATION, BACKGROUND = 0, 1, 2
+
+PRIORITIES = {
+    'complete': INTERACTIVE,
+    'entity': INTERACTIVE,
+    'locals': INTERACTIVE,
+    'outline': NAVIGATION,
+    'members': NAVIGATION,
+    'globals': BACKGROUND,
+    'builtins': BACKGROUND,
+    'namespaces': BACKGROUND,
+    'parse': BACKGROUND,
+}
+
+# Commands whose response only depends on the arguments and the code
+CACHEABLE = ('outline', 'entity', 'locals', 'members', 'complete', 'builtins', 'namespaces')
+
+
+def command_line(args, rsp=None, cwd=None):
+    """ Obtain the arguments and working directory to spawn a server,
+        including the references found in the rsp file if any.
+    """
+    args = list(args)
+    if rsp:
+        cwd = os.path.dirname(rsp)
+        args += read_rsp(rsp)
+        #args.append('@{0}'.format(rsp))
+
+    return args, cwd
+
+
+# Options parsed from each rsp file along with its modification time and size
+_RSP_CACHE = {}
+
+
+def read_rsp(rsp):
+    """ Extract the references and options relevant to the server from a rsp
+        file. The result is reused until the file changes.
+    """
+    st = os.stat(rsp)
+    cached = _RSP_CACHE.get(rsp)
+    if cached and cached[0] == (st.st_mtime, st.st_size):
+        return list(cached[1])
+
+    with open(rsp) as fp:
+        lines = [ln.strip() for ln in fp.readlines()]
+    options = [ln for ln in lines if ln.startswith('-r')]
+    options += [ln.replace('-o', '-r') for ln in lines if ln.startswith('-o')]
+    options += [ln for ln in lines if ln.startswith('-ducky')]
+
+    _RSP_CACHE[rsp] = ((st.st_mtime, st.st_size), options)
+    return list(options)
+
+
+def references(args, cwd=None):
+    """ Paths of the referenced assemblies found in the arguments """
+    refs = []
+    for arg in args:
+        if arg.startswith('-r'):
+            refs.append(os.path.join(cwd or '.', arg.split(':', 1)[-1]))
+    return refs
+
+
+def shared_name(command, kwargs):
+    """ Name identifying a query not depending on any document """
+    if not kwargs:
+        return command
+    return '{0}:{1}'.format(command, json.dumps(kwargs, sort_keys=True))
+
+
+def text_delta(old, new):
+    """ Finds a single edit transforming `old` into `new`, returned as the
+        tuple (start, end, text) to replace old[start:end] with text.
+    """
+    limit = min(len(old), len(new))
+
+    # Binary search the common prefix and suffix comparing whole slices,
+    # which is way faster than walking the strings character by character.
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[:mid] == new[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    prefix = lo
+
+    lo, hi = 0, limit - prefix
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[len(old) - mid:] == new[len(new) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    suffix = lo
+
+    return prefix, len(old) - suffix, new[prefix:len(new) - suffix]
+
+
+def encode_query(query):
+    """ Serialize a query as a line for the server """
+    return json.dumps(
+        query,
+        check_circular=False,  # Try to make it a bit faster
+        separators=(',', ':')  # Make it more compact
+    ).encode('utf-8') + b'\n'
+
+
+class Document(object):
+    """ Contents of a source file at a given version, usually the change
+        count of the editor buffer.
+    """
+
+    def __init__(self, fname, version, text):
+        self.fname = fname
+        self.version = version
+        self.text = text
+        self._digest = None
+
+    def digest(self):
+        """ Hash of the contents, computed once """
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.text.encode('utf-8')).hexdigest()
+        return self._digest
+
+
+class PipeTransport(object):
+    """ Child process running the compiler in server mode, talking with it
+        via its standard pipes.
+    """
+
+    def __init__(self, args, cwd):
+        self.proc = subprocess.Popen(
+            args,
+            cwd=cwd,
+            shell=False,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            bufsize=0,
+            close_fds=True
+        )
+        self.pid = self.proc.pid
+        # Pipes watched by the reactor for the responses and the errors
+        self.reader = self.proc.stdout
+        self.errors = self.proc.stderr
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def poll(self):
+        """ Exit code of the process, None while running """
+        return self.proc.poll()
+
+    def close(self):
+        proc = self.proc
+        if proc.poll() is None:
+            # Try to terminate the compiler gracefully
+            try:
+                logger.info('Terminating hint server process %s', proc.pid)
+                proc.stdin.write("quit\n".encode('utf-8'))
+                proc.terminate()
+            except IOError:
+                pass
+
+        # If still alive try to kill it
+        if proc.poll() is None:
+            proc.kill()
+
+
+class SocketTransport(object):
+    """ Connection to a server process owned by the daemon, which can be
+        shared with other clients (see `BooHints.daemon`). Closing it just
+        detaches from the process.
+    """
+
+    def __init__(self, path, args, cwd, slot=0, replace=None, timeout=5.0):
+        # Whoever owns the socket receives the code and answers the queries
+        if os.stat(path).st_uid != os.getuid():
+            raise IOError('Socket {0} belongs to another user'.format(path))
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+            self.check_peer()
+            self.sock.sendall(encode_query({
+                'command': 'attach', 'args': list(args), 'cwd': cwd, 'slot': slot,
+                'replace': replace}))
+            resp = json.loads(self.readline().decode('utf-8'))
+            self.sock.settimeout(None)
+        except (IOError, OSError, ValueError, socket.timeout):
+            self.sock.close()
+            raise
+        if 'error' in resp:
+            self.sock.close()
+            raise IOError(resp['error'])
+
+        self.pid = resp.get('pid')
+        self._exit = None
+        self.reader = self.sock.makefile('rb', 0)
+        # Errors are logged by the daemon
+        self.errors = None
+
+    def check_peer(self):
+        """ Make sure the daemon runs as the current user where the system
+            reports it, the socket could have been replaced after checking.
+        """
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return
+        creds = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        if uid != os.getuid():
+            raise IOError('Hint server daemon runs as another user')
+
+    def readline(self):
+        """ Read the handshake response, without consuming any data after it
+            which belongs to the reactor.
+        """
+        data = b''
+        while not data.endswith(b'\n'):
+            char = self.sock.recv(1)
+            if not char:
+                raise IOError('Connection closed by the hint server daemon')
+            data += char
+        return data
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def poll(self):
+        return self._exit
+
+    def close(self):
+        if self._exit is not None:
+            return
+        self._exit = 0
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        # The descriptor is released once the reader is collected too, so it
+        # can still be removed from the reactor.
+        self.sock.close()
+
+
 class Server(object):
     """ Represents a connection with the hints server, taking care of spawning
         a child process running the compiler in server mode and handling the
-        communication with it via standard pipes.
+        communication with it via standard pipes, or attaching to a process
+        owned by the daemon when `daemon` gives the path of its socket.
     """
 
-    def __init__(self, bin, args=None, rsp=None, cwd=None, timeout=300):
+    def __init__(self, bin, args=None, rsp=None, cwd=None, timeout=300, pipelined=None,
+                 sync_documents=False, cache=None, prefetch=('builtins', 'namespaces'),
+                 cache_dir=None, timeouts=None, record=None, framing=False,
+                 daemon=None, batching=False):
         try:
             args.insert(0, bin)
             self.args = args
@@ -36,17 +300,94 @@ class Server(object):
         self.cwd = cwd
         self.rsp = rsp
         self.timeout = timeout
-        self.proc = None
+        self._last_usage = 0
+        self.transport = None
+        # Socket of the daemon sharing the processes among clients, workers
+        # of a pool use a different slot to get their own process.
+        self.daemon = daemon
+        self.slot = 0
         self.results = queue.Queue()
-        self.async_queries = queue.Queue()
+        self.async_queries = Mailbox(DISPATCHER, self)
         self.lock = threading.Lock()
+        # Queries waiting for a response tagged with their id
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._inflight = 0
+        # Number of blocking queries someone is waiting for
+        self._foreground = 0
+        # Whether the server echoes back the query id in its responses. When
+        # unknown (None) it gets detected with the first response.
+        self.pipelined = pipelined
+        # Latest contents of the documents referred by name in the queries
+        self.documents = {}
+        # When the server supports it only the changes are sent, keeping the
+        # version last sent to the current process for each document.
+        self.sync_documents = sync_documents
+        self.synced = {}
+        # Documents closed while a query was in flight, the server is told
+        # before the next query.
+        self.closing = set()
+        # Responses for the cacheable commands, can be shared among servers.
+        # Passing False disables it.
+        if cache is None:
+            cache = ResponseCache()
+        self.cache = cache if cache is not False else None
+        # Hints not depending on any document (builtins, namespaces), they
+        # are fetched as soon as the process spawns for the prefetch ones.
+        self.shared = {}
+        self.prefetch = prefetch
+        # Directory to persist the shared hints across restarts
+        self.cache_dir = cache_dir
+        self.disk = None
+        # Time given to each command, learnt from their latencies. Can be
+        # shared among servers, a dict configures a new one.
+        if not isinstance(timeouts, AdaptiveTimeouts):
+            timeouts = AdaptiveTimeouts(**(timeouts or {}))
+        self.timeouts = timeouts
+        # Timer restarting the process when the late response of a timed out
+        # serialized query never arrives. While set the lock is kept so that
+        # response is not taken as the one of the next query.
+        self._drain = None
+        # Whether the server supports batches of queries, when unknown (None)
+        # it gets detected with the first batch. Disabled unless asked for,
+        # then they are issued one by one.
+        self.batching = None if batching else False
+        # Use the framed protocol, receiving long lists of hints in pages.
+        # Callbacks for the pages of streamed queries and the hints received
+        # so far for the rest, by query id.
+        self.framing = framing
+        self.streams = {}
+        self.partial = {}
+        # Log file recording the traffic with the process
+        self.record = record
+        self.recorder = get_recorder(record) if record else None
         self._needs_restart = False
-        self._invalid = False
+        # Process of the daemon which must not be attached to again, it was
+        # restarted. Other clients asking the same get the replacement.
+        self.replaces = None
+        # Called with the server when its references change, allowing to
+        # swap in a fresh one. Without it the process is simply restarted.
+        self.on_stale = None
+        # Crash recovery: consecutive crashes, recent fast ones and the time
+        # until which respawning is delayed or the circuit breaker is open.
+        self._spawned_at = 0
+        self._failures = 0
+        self._fast_crashes = []
+        self._retry_at = 0
+        self._breaker_until = 0
+        self._half_open = False
 
-        # Setup threads for reading results and errors
-        threading.Thread(target=self.thread_async).start()
-        threading.Thread(target=self.thread_stdout).start()
-        threading.Thread(target=self.thread_stderr).start()
+    # Respawn delay after a crash, doubled for each consecutive one
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30.0
+    # A process dying sooner than this after spawning is a fast crash
+    FAST_CRASH = 10.0
+    # Fast crashes within the window which open the circuit breaker
+    BREAKER_CRASHES = 5
+    BREAKER_WINDOW = 60.0
+    # Time without respawning once the breaker opens
+    BREAKER_COOLDOWN = 600.0
 
     def start(self):
         self._last_usage = time.time()
@@ -54,119 +395,251 @@ class Server(object):
         if self._needs_restart:
             self._needs_restart = False
             logger.info('Restarting server...')
-            self.stop()
+            METRICS.count('restarts')
+            self.terminate()
         # Nothing to do if already running
         elif self.is_alive():
             return
 
-        args = list(self.args)
-        cwd = self.cwd
-        if self.rsp:
-            cwd = os.path.dirname(self.rsp)
-            # Extract references from rsp
-            with open(self.rsp) as fp:
-                lines = fp.readlines()
-                lines = [ln.strip() for ln in lines]
-                args += [ln for ln in lines if ln.startswith('-r')]
-                args += [ln.replace('-o', '-r') for ln in lines if ln.startswith('-o')]
-                args += [ln for ln in lines if ln.startswith('-ducky')]
-            #args.append('@{0}'.format(self.rsp))
+        args, cwd = command_line(self.args, self.rsp, self.cwd)
+        if self.framing:
+            args.append(FRAMED_ARG)
 
-        self.proc = subprocess.Popen(
-            args,
-            cwd=cwd,
-            shell=False,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            bufsize=0,
-            close_fds=True
-        )
+        self.transport = None
+        if self.daemon:
+            try:
+                self.transport = SocketTransport(self.daemon, args, cwd, self.slot,
+                                                 self.replaces)
+                logger.info('Attached to hint server with PID %s from daemon %s',
+                            self.transport.pid, self.daemon)
+            except (IOError, OSError, ValueError, socket.timeout) as ex:
+                logger.warning('Unable to use hint server daemon %s: %s', self.daemon, ex)
+                METRICS.count('daemon_errors')
+        if self.transport is None:
+            self.transport = PipeTransport(args, cwd)
+            logger.info('Started hint server with PID %s using: %s',
+                        self.transport.pid, ' '.join(args))
+
+        self._spawned_at = time.time()
+        METRICS.count('spawns')
 
-        logger.info('Started hint server with PID %s using: %s',
-                    self.proc.pid, ' '.join(args))
+        # A new process knows nothing about our documents
+        self.synced = {}
 
-        # Start monitoring the connection last usage timeout
-        self.check_timeout()
+        # References may have changed since the disk cache was opened
+        self.disk_cache(args, cwd)
+        for command in self.prefetch:
+            self.fetch_shared(command)
+
+        # Results and errors are read from the shared reactor thread
+        transport = self.transport
+        if self.framing:
+            decoder = FrameDecoder()
+            REACTOR.add_reader(transport.reader, lambda data: self.on_frames(transport, decoder, data),
+                               lambda: self.on_exit(transport), raw=True)
+        else:
+            REACTOR.add_reader(transport.reader, self.on_stdout,
+                               lambda: self.on_exit(transport))
+        if transport.errors is not None:
+            REACTOR.add_reader(transport.errors, self.on_stderr)
+
+        if self.sync_documents:
+            self.replay_documents()
+
+        # Let the supervisor monitor the idle timeout and process limits
+        SUPERVISOR.started(self)
 
     def stop(self):
-        if not self.proc:
+        """ Terminates the process discarding any pending async query """
+        self.async_queries.clear()
+        self.terminate()
+
+    def terminate(self):
+        transport = self.transport
+        if not transport:
             return
 
-        if self.is_alive():
-            # Try to terminate the compiler gracefully
-            try:
-                logger.info('Terminating hint server process %s', self.proc.pid)
-                self.proc.stdin.write("quit\n".encode('utf-8'))
-                self.proc.terminate()
-            except IOError:
-                pass
+        # Detach the process first so its exit is not seen as abnormal
+        self.transport = None
+        REACTOR.remove_reader(transport.reader)
+        if transport.errors is not None:
+            REACTOR.remove_reader(transport.errors)
+        transport.close()
 
-        # If still alive try to kill it
-        if self.is_alive():
-            self.proc.kill()
+        self.reset_pending()
+        self.end_drain()
 
-        self.proc = None
+    def last_usage(self):
+        return self._last_usage
 
-    def check_timeout(self):
-        if time.time() - self._last_usage > self.timeout:
-            self.stop()
-        # Run the check again after a timeout
-        elif self.is_alive():
-            threading.Timer(self.timeout, self.check_timeout).start()
+    def is_busy(self):
+        """ Check if there are queries in flight or waiting to be issued """
+        return self.load() > 0
+
+    def pid(self):
+        transport = self.transport
+        return transport.pid if transport else None
 
     def is_alive(self):
-        alive = self.proc and self.proc.poll() is None and hasattr(self.proc, 'stdin')
-        if not alive:
-            self.reset_queue(self.results)
-            self.reset_queue(self.async_queries)
-        return alive
+        transport = self.transport
+        return transport is not None and transport.poll() is None
 
-    def thread_stdout(self):
-        """ Thread to consume stdout contents """
-        while True:
-            if not self.is_alive():
-                time.sleep(0.1)
-                continue
+    def is_shared(self):
+        """ Check if the process is owned by the daemon """
+        return isinstance(self.transport, SocketTransport)
 
-            line = self.proc.stdout.readline()
-            if 0 == len(line):
-                continue
-            line = line.decode('utf-8')
-            line = line.rstrip()
-            if line.startswith('#'):
-                line = line[1:]
-                if line.startswith('!'):
-                    self.server_command(line[1:])
-                else:
-                    logger.debug(line)
-            else:
-                self.results.put(line)
+    def on_exit(self, transport):
+        """ Called from the reactor once the stdout of a process is closed """
+        # Ignore processes already stopped or replaced
+        if transport is not self.transport:
+            return
 
-    def thread_stderr(self):
-        """ Thread to consume stderr contents """
-        while True:
-            if not self.is_alive():
-                time.sleep(0.1)
-                continue
+        logger.warning('Hint server process %s exited with code %s',
+                       transport.pid, transport.poll())
+        transport.close()
+        # Don't make the queries in flight wait for a timeout
+        self.reset_pending()
+        self.results.put(None)
+        self.end_drain()
+        METRICS.count('crashes')
 
-            line = self.proc.stderr.readline()
-            if 0 == len(line):
-                continue
-            line = line.decode('utf-8')
-            line = line.rstrip()
-            if line.startswith('#'):
-                logger.warning(line[1:])
+        self.schedule_respawn()
+
+    def schedule_respawn(self):
+        """ Respawn a crashed process after an exponential backoff with
+            jitter. Repeated fast crashes open a circuit breaker instead,
+            giving up on the server for a while.
+        """
+        now = time.time()
+        fast = now - self._spawned_at < self.FAST_CRASH
+        if fast:
+            self._failures += 1
+            self._fast_crashes = [x for x in self._fast_crashes if now - x < self.BREAKER_WINDOW]
+            self._fast_crashes.append(now)
+        else:
+            self._failures = 1
+            self._fast_crashes = []
+            self._half_open = False
+
+        if fast and (self._half_open or len(self._fast_crashes) >= self.BREAKER_CRASHES):
+            self._breaker_until = now + self.BREAKER_COOLDOWN
+            self._half_open = True
+            METRICS.count('breaker_opened')
+            logger.error('Hint server keeps crashing, disabling it for %d seconds',
+                         self.BREAKER_COOLDOWN)
+            return
+
+        delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** (self._failures - 1))
+        delay *= random.uniform(0.5, 1.5)
+        self._retry_at = now + delay
+        logger.info('Respawning hint server in %.1f seconds', delay)
+        TIMERS.call_later(delay, self.respawn)
+
+    def respawn(self):
+        """ Spawn the process again after a crash unless already done """
+        # Runs in the timer thread, a query holding the lock spawns it anyway
+        if not self.lock.acquire(False):
+            return
+        try:
+            if self.is_alive() or not self.available():
+                return
+            self.start()
+        finally:
+            self.lock.release()
+
+    def available(self):
+        """ Check if queries can be issued, which is not the case while
+            waiting to respawn after a crash or with the breaker open.
+        """
+        if self.is_alive():
+            return True
+        now = time.time()
+        return now >= self._retry_at and now >= self._breaker_until
+
+    def reset(self):
+        """ Forget about previous crashes, closing the circuit breaker """
+        self._failures = 0
+        self._fast_crashes = []
+        self._retry_at = 0
+        self._breaker_until = 0
+        self._half_open = False
+
+    def replay_documents(self):
+        """ Send every document to a freshly spawned process. Must be
+            called while holding the lock.
+        """
+        for fname, doc in list(self.documents.items()):
+            self.notify('open', fname=fname, version=doc.version, code=doc.text)
+            self.synced[fname] = doc
+
+    def on_frames(self, transport, decoder, data):
+        """ Consume data from stdout with the framed protocol """
+        try:
+            for payload in decoder.feed(data):
+                self.on_stdout(payload)
+        except FrameError as ex:
+            # Out of sync with the process, handle it like a crash
+            logger.error('Invalid data from hint server %s: %s', transport.pid, ex)
+            REACTOR.remove_reader(transport.reader)
+            if transport.errors is not None:
+                REACTOR.remove_reader(transport.errors)
+            self.on_exit(transport)
+
+    def on_stdout(self, line):
+        """ Consume a line from stdout """
+        line = line.decode('utf-8')
+        line = line.rstrip()
+        if not line:
+            return
+        if self.recorder:
+            self.recorder.write(self.pid(), '<', line)
+        if line.startswith('#'):
+            line = line[1:]
+            if line.startswith('!'):
+                self.server_command(line[1:])
             else:
-                logger.error(line)
-                # self.results.put(None)
+                logger.debug(line)
+        else:
+            self.dispatch(line)
 
-    def thread_async(self):
-        """ Thread to perform async queries """
-        while True:
-            callback, command, kwargs = self.async_queries.get()
-            resp = self.query(command, **kwargs)
-            callback(resp)
+    def on_stderr(self, line):
+        """ Consume a line from stderr """
+        line = line.decode('utf-8')
+        line = line.rstrip()
+        if not line:
+            return
+        if line.startswith('#'):
+            logger.warning(line[1:])
+        else:
+            logger.error(line)
+
+    def run_async(self):
+        """ Perform the next async query, called from a dispatcher thread.
+            While a blocking query is running only interactive ones are
+            issued, the rest wait until it completes.
+        """
+        limit = INTERACTIVE if self._foreground else None
+        item = self.async_queries.get(limit)
+        if item is None:
+            self.async_queries.done(idle=True)
+            # The blocking query may have completed in the meantime
+            if not self._foreground:
+                self.async_queries.resume()
+            return
+
+        try:
+            callback, command, kwargs, stale, queued = item
+            TRACER.complete('queue', queued, time.time(), command=command)
+            if stale and stale():
+                logger.debug('Cancelled stale async query %s', command)
+                METRICS.count('cancelled')
+            else:
+                with TRACER.span('query', command=command, fname=kwargs.get('fname')):
+                    resp = self._query(command, kwargs)
+                with TRACER.span('callback', command=command):
+                    callback(resp)
+        finally:
+            self.async_queries.done()
 
     def reset_queue(self, queue):
         """ Make sure the queue is empty """
@@ -176,57 +649,577 @@ class Server(object):
         except:
             pass
 
+    def reset_pending(self):
+        """ Wake up every query waiting for a response with an empty one """
+        with self.pending_lock:
+            waiters = list(self.pending.values())
+            self.pending.clear()
+        for waiter in waiters:
+            waiter.put(None)
+
+    def dispatch(self, line):
+        """ Routes a response line to the query waiting for it. Responses
+            tagged with an id go to its pending query, untagged ones are
+            consumed by the serialized query currently holding the lock.
+        """
+        try:
+            with TRACER.span('decode', size=len(line)):
+                resp = json.loads(line)
+        except Exception as ex:
+            logger.error(str(ex), exc_info=True)
+            resp = None
+
+        qid = resp.get('id') if isinstance(resp, dict) else None
+        if isinstance(resp, dict) and 'more' in resp:
+            if not self.collect_page(qid, resp):
+                return
+            # The whole response is never available as a single line
+            line = None
+
+        if qid is not None:
+            with self.pending_lock:
+                waiter = self.pending.pop(qid, None)
+            if waiter is not None:
+                waiter.put((resp, line))
+                return
+            if self.pipelined:
+                logger.debug('Discarding response for query %s', qid)
+                METRICS.count('late_responses')
+                return
+
+        # Queued while checking for a drain so `drain` never misses it
+        with self.pending_lock:
+            drain, self._drain = self._drain, None
+            if drain is None:
+                self.results.put((resp, line))
+        if drain is not None:
+            logger.debug('Discarding late response')
+            METRICS.count('late_responses')
+            drain.cancel()
+            self.lock.release()
+
+    def collect_page(self, qid, resp):
+        """ Hands over the hints in a page of a response, either to the
+            callback streaming them or accumulating them until the last page.
+            Returns True once the response is complete.
+        """
+        with self.pending_lock:
+            on_page = self.streams.get(qid)
+            hints = self.partial.get(qid)
+            if on_page is None and hints is None:
+                hints = self.partial[qid] = []
+
+        if on_page is not None:
+            on_page(resp.get('hints', []))
+        else:
+            hints.extend(resp.get('hints', []))
+
+        if resp.pop('more'):
+            return False
+
+        with self.pending_lock:
+            self.partial.pop(qid, None)
+        # Streamed hints are not kept, only the callback received them
+        resp['hints'] = hints if on_page is None else []
+        return True
+
     def server_command(self, line):
         """ Answers server commands
         """
         if line.startswith('ReferenceModified:'):
-            # Force a restart of the server as soon as possible
-            self._needs_restart = True
-            self.query_async(lambda x: x, 'parse', fname='reload', code='')
+            if self.cache is not None:
+                self.cache.clear()
+            if self.on_stale is not None:
+                self.on_stale(self)
+            else:
+                self.schedule_restart()
         else:
             logger.info('Unsupported server command: %s', line)
 
+    def schedule_restart(self):
+        """ Force a restart of the server as soon as possible """
+        self.replaces = self.pid()
+        self._needs_restart = True
+        self.query_async(lambda x: x, 'parse', fname='reload', code='')
+
+    def invalidate(self):
+        """ Forget the hints obtained so far """
+        self.shared = {}
+        self.disk = None
+        if self.cache is not None:
+            self.cache.clear()
+
+    def warm(self):
+        """ Spawn the process and wait until the shared hints are available
+            and the documents were compiled once, which loads the referenced
+            assemblies. Blocks for a while so it should run in a thread.
+        """
+        for command in self.prefetch:
+            self.shared_hints(command, block=True)
+        for fname in list(self.documents):
+            self.query('parse', fname=fname)
+
+    def retire(self):
+        """ Terminate the process once the queries in flight or waiting to
+            be issued are finished.
+        """
+        if self.is_busy():
+            TIMERS.call_later(0.5, self.retire)
+        else:
+            self.stop()
+
+    def builtins(self, block=False):
+        return self.shared_hints('builtins', block)
+
+    def namespaces(self, block=False):
+        return self.shared_hints('namespaces', block)
+
+    def type_members(self, fullname, block=False):
+        """ Members of a namespace or type given its full name """
+        return self.shared_hints(
+            'members', block,
+            code='{0}.'.format(fullname),
+            offset=len(fullname) + 1,
+            extra=True)
+
+    def shared_hints(self, command, block=False, **kwargs):
+        """ Obtain the cached hints for a query not depending on any
+            document. When not available yet they are requested in the
+            background returning None, unless `block` is set to wait for them.
+
+            With a disk cache the hints from a previous session are returned
+            right away while they get refreshed in the background.
+        """
+        name = shared_name(command, kwargs)
+        hints = self.shared.get(name)
+        if hints is not None:
+            return hints
+
+        disk = self.disk_cache()
+        hints = disk.get(name) if disk else None
+        if hints is not None:
+            self.shared[name] = hints
+            # Builtins and namespaces are refreshed once the process spawns
+            if command not in self.prefetch:
+                self.fetch_shared(command, **kwargs)
+        elif block:
+            kwargs.setdefault('code', '')
+            self.store_shared(name, self.query(command, fname='prefetch', **kwargs))
+            hints = self.shared.get(name)
+        else:
+            self.fetch_shared(command, **kwargs)
+        return hints
+
+    def fetch_shared(self, command, **kwargs):
+        """ Refresh the shared hints for a query in the background """
+        name = shared_name(command, kwargs)
+        kwargs.setdefault('code', '')
+
+        # With the framed protocol the hints are available as they arrive
+        pages = []
+
+        def on_page(hints):
+            pages.extend(hints)
+            self.shared.setdefault(name, pages)
+
+        def callback(resp):
+            if resp and pages:
+                resp['hints'] = pages
+            self.store_shared(name, resp)
+
+        self.query_async(
+            callback,
+            command,
+            key=('prefetch', name),
+            priority=BACKGROUND,
+            fname='prefetch',
+            on_page=on_page,
+            **kwargs)
+
+    def store_shared(self, name, resp):
+        if not resp:
+            return
+        self.shared[name] = resp['hints']
+        disk = self.disk_cache()
+        if disk:
+            disk.put(name, resp['hints'])
+
+    def disk_cache(self, args=None, cwd=None):
+        """ Obtain the disk cache for the current references, opening a new
+            one when the process is spawned with the given arguments.
+        """
+        if not self.cache_dir:
+            return None
+        if args is not None or self.disk is None:
+            if args is None:
+                try:
+                    args, cwd = command_line(self.args, self.rsp, self.cwd)
+                except (IOError, OSError) as ex:
+                    logger.error('Unable to read rsp file: %s', ex)
+                    return None
+            self.disk = DiskCache(self.cache_dir, args, cwd)
+        return self.disk
+
+    def update_document(self, fname, version, text):
+        """ Register the contents of a document so queries can refer to it
+            just by its file name. The text can be given as a callable, it is
+            only invoked when the version differs from the registered one.
+        """
+        doc = self.documents.get(fname)
+        if doc is None or doc.version != version:
+            if callable(text):
+                text = text()
+            self.documents[fname] = Document(fname, version, text)
+
+    def close_document(self, fname):
+        """ Forget about a document """
+        self.documents.pop(fname, None)
+        if not self.sync_documents or fname not in self.synced:
+            return
+
+        # Never wait for a query in flight, it is called from the UI thread
+        self.closing.add(fname)
+        if self.lock.acquire(False):
+            try:
+                self.flush_closing()
+            finally:
+                self.lock.release()
+
+    def flush_closing(self):
+        """ Notify the closed documents. Must be called while holding the
+            lock.
+        """
+        while self.closing:
+            fname = self.closing.pop()
+            # Reopened meanwhile, it gets synced again from scratch
+            if self.synced.pop(fname, None) and fname not in self.documents and self.is_alive():
+                self.notify('close', fname=fname)
+
+    def notify(self, command, **kwargs):
+        """ Sends a command without waiting for a response. Must be called
+            while holding the lock.
+        """
+        kwargs['command'] = command
+        data = encode_query(kwargs)
+        self.transport.write(data)
+        METRICS.count('notify_bytes', len(data))
+        if self.recorder:
+            self.recorder.write(self.transport.pid, '>', data)
+
+    def send(self, query, fname=None):
+        """ Writes a query to the running process, first bringing it up to
+            date with the referenced document. Must be called while holding
+            the lock.
+        """
+        with TRACER.span('write', size=len(query)):
+            self._send(query, fname)
+
+    def _send(self, query, fname):
+        self.flush_closing()
+        doc = self.documents.get(fname)
+        if doc is not None and self.sync_documents:
+            synced = self.synced.get(fname)
+            if synced is None:
+                self.notify('open', fname=fname, version=doc.version, code=doc.text)
+            elif synced.version != doc.version:
+                start, end, text = text_delta(synced.text, doc.text)
+                self.notify('change', fname=fname, version=doc.version,
+                            start=start, end=end, text=text)
+            self.synced[fname] = doc
+
+        self.transport.write(query)
+        if self.recorder:
+            self.recorder.write(self.transport.pid, '>', query)
+
     def query(self, command, **kwargs):
-        if self._invalid:
-            logger.error('Process was flagged as invalid. It ended abnormally.')
+        """ Issue a query and wait for its response. Unless some code is given
+            a registered document matching `fname` is used as source.
+        """
+        with self.pending_lock:
+            self._foreground += 1
+        try:
+            with TRACER.span('query', command=command, fname=kwargs.get('fname')):
+                return self._query(command, kwargs)
+        finally:
+            with self.pending_lock:
+                self._foreground -= 1
+            self.async_queries.resume()
+
+    def query_batch(self, queries, **kwargs):
+        """ Issue several queries in a single round trip, returning a list
+            with their responses. Each query is a dict with its command and
+            arguments, the rest of arguments (usually `fname` and `code`) are
+            shared by all of them and sent only once.
+
+            When the server does not support batches the queries are issued
+            one after the other.
+        """
+        return self.query('batch', queries=queries, **kwargs)
+
+    def query_batch_async(self, callback, queries, priority=None, **kwargs):
+        """ Runs a batch of queries in a dispatcher thread, by default with
+            the most urgent priority among them.
+        """
+        if priority is None:
+            priority = min(PRIORITIES.get(q['command'], NAVIGATION) for q in queries)
+        self.query_async(callback, 'batch', queries=queries, priority=priority, **kwargs)
+
+    def _query(self, command, kwargs):
+        if command == 'batch':
+            return self._query_batch(kwargs)
+        return self._request(command, kwargs)
+
+    def _query_batch(self, kwargs):
+        queries = kwargs.pop('queries')
+
+        if self.batching is not False:
+            resp = self._request('batch', dict(kwargs, queries=queries))
+            if resp is None and not self.available():
+                return [None] * len(queries)
+
+            results = resp.get('results') if isinstance(resp, dict) else None
+            if isinstance(results, list) and len(results) == len(queries):
+                self.batching = True
+                return results
+
+            logger.info('Hint server does not support batches')
+            self.batching = False
+
+        results = []
+        for query in queries:
+            query = dict(kwargs, **query)
+            results.append(self._request(query.pop('command'), query))
+        return results
+
+    def _request(self, command, kwargs):
+        # Receives the pages of hints as they arrive with the framed protocol
+        on_page = kwargs.pop('on_page', None)
+
+        if not self.available():
+            logger.debug('Hint server not available, skipping %s query', command)
+            METRICS.count('unavailable')
             return None
 
-        # Issue the command
+        key = self.cache_key(command, kwargs) if self.cache is not None else None
+        if key is not None:
+            line = self.cache.get(key)
+            if line is not None:
+                METRICS.count('cache_hits')
+                resp = json.loads(line)
+                resp.pop('id', None)
+                return resp
+            METRICS.count('cache_misses')
+
+        fname = kwargs.get('fname')
+        if 'code' in kwargs or fname not in self.documents:
+            fname = None
+        elif not self.sync_documents:
+            kwargs['code'] = self.documents[fname].text
+
+        # Issue the command tagged with an unique id
+        qid = next(self._ids)
         kwargs['command'] = command
-        query = json.dumps(
-            kwargs,
-            check_circular=False,  # Try to make it a bit faster
-            separators=(',', ':')  # Make it more compact
-        ).encode('utf-8')
-
-        # Uses a lock to sequence the commands to the child process in order to
-        # avoid mixed results in the output.
-        with self.lock:
+        kwargs['id'] = qid
+        query = encode_query(kwargs)
+
+        started = time.time()
+        with self.pending_lock:
+            self._inflight += 1
+            if on_page is not None:
+                self.streams[qid] = on_page
+        try:
+            if self.pipelined:
+                resp, line = self._query_pipelined(qid, query, command, fname)
+            else:
+                resp, line = self._query_serialized(qid, query, command, fname)
+        finally:
+            with self.pending_lock:
+                self._inflight -= 1
+                self.streams.pop(qid, None)
+                self.partial.pop(qid, None)
+
+        if isinstance(resp, dict):
+            METRICS.query(command, kwargs.get('fname'), time.time() - started,
+                          len(query), len(line or ''))
+            resp.pop('id', None)
+            if key is not None and line is not None:
+                self.cache.put(key, line)
+        return resp
+
+    def cache_key(self, command, kwargs):
+        """ Obtain the key identifying a query in the response cache from its
+            command, file, a hash of the code and the rest of the arguments,
+            or None if it cannot be cached.
+        """
+        if command not in CACHEABLE:
+            return None
+
+        fname = kwargs.get('fname')
+        if 'code' in kwargs:
+            digest = hashlib.sha1(kwargs['code'].encode('utf-8')).hexdigest()
+        elif fname in self.documents:
+            digest = self.documents[fname].digest()
+        else:
+            digest = None
+
+        args = dict((k, v) for k, v in kwargs.items() if k not in ('code', 'fname'))
+        return (command, fname, digest, json.dumps(args, sort_keys=True))
+
+    def _query_pipelined(self, qid, query, command, fname=None):
+        """ Sends the query without waiting for others in flight, the
+            response is routed back by its id from the stdout thread.
+        """
+        waiter = queue.Queue(1)
+        try:
+            # The lock only guards spawning the process and writing to it
+            waiting = time.time()
+            with self.lock:
+                TRACER.complete('lock', waiting, time.time(), command=command)
+                self.start()
+                with self.pending_lock:
+                    self.pending[qid] = waiter
+                self.send(query, fname)
+            return self._wait(waiter, command)
+        finally:
+            with self.pending_lock:
+                self.pending.pop(qid, None)
+
+    def _query_serialized(self, qid, query, command, fname=None):
+        """ Fallback for servers not echoing the query id. Uses a lock to
+            sequence the commands to the child process in order to avoid
+            mixed results in the output.
+        """
+        # Waiting for the queries before this one counts against its own
+        # timeout, a quick query is never held for as long as a slow one.
+        waiting = time.time()
+        if not self.acquire(self.timeouts.timeout(command)):
+            logger.error('Timeout waiting for the hint server to issue %s', command)
+            METRICS.count('lock_timeouts')
+            return None, None
+        draining = False
+        try:
+            TRACER.complete('lock', waiting, time.time(), command=command)
             # Make sure we have a server running
             self.start()
 
             # Reset the response queue
             self.reset_queue(self.results)
 
-            # Send the query and wait for the results
-            self.proc.stdin.write(query + '\n'.encode('utf-8'))
-            resp = None
+            # Send the query and wait for the results. Its response is routed
+            # by id too in case pipelining gets detected by a concurrent query.
+            with self.pending_lock:
+                self.pending[qid] = self.results
             try:
-                resp = self.results.get(timeout=3.0)
-                if resp is not None:
-                    resp = json.loads(resp)
+                self.send(query, fname)
+                resp, line = self._wait(self.results, command, qid)
+            finally:
+                with self.pending_lock:
+                    self.pending.pop(qid, None)
+
+            # Detect if the server supports pipelining with the first response
+            if self.pipelined is None and isinstance(resp, dict):
+                self.pipelined = resp.get('id') == qid
+                logger.info('Hint server %s pipelined queries',
+                            'supports' if self.pipelined else 'does not support')
+
+            # Timed out, the lock is kept until the late response arrives
+            draining = resp is None and line is None and self.drain(command)
+            return resp, line
+        finally:
+            if not draining:
+                self.lock.release()
+
+    def drain(self, command):
+        """ Keep the lock after a serialized query timed out until its late
+            response arrives, it is discarded instead of being taken by the
+            next query. A process not answering within the timeout ceiling is
+            restarted. Returns False when there is nothing to wait for.
+        """
+        def expire():
+            with self.pending_lock:
+                expired = self._drain is timer
+                if expired:
+                    self._drain = None
+            if expired:
+                logger.error('Hint server never answered %s, restarting it', command)
+                METRICS.count('drain_restarts')
+                self.replaces = self.pid()
+                self.terminate()
+                self.lock.release()
+
+        delay = max(0, self.timeouts.ceiling - self.timeouts.timeout(command))
+        with self.pending_lock:
+            # The process exited or the response arrived meanwhile
+            if not self.is_alive() or not self.results.empty():
+                return False
+            timer = self._drain = TIMERS.call_later(delay, expire)
+        return True
+
+    def end_drain(self):
+        """ Stop waiting for a late response, the process is gone """
+        with self.pending_lock:
+            drain, self._drain = self._drain, None
+        if drain is not None:
+            drain.cancel()
+            self.lock.release()
+
+    def acquire(self, timeout):
+        """ Take the lock giving up after the timeout """
+        try:
+            return self.lock.acquire(True, max(0, timeout))
+        except TypeError:
+            # Locks can not time out with Python 2
+            return self.lock.acquire()
+
+    def _wait(self, results, command, qid=None):
+        """ Waits for a response returning it decoded along with its line.
+            The time given depends on the latencies seen for the command.
+            When a query id is given responses tagged with another one are
+            discarded, they arrived after their query timed out.
+        """
+        timeout = self.timeouts.timeout(command)
+        started = time.time()
+        while True:
+            remaining = started + timeout - time.time()
+            try:
+                if remaining <= 0:
+                    raise queue.Empty()
+                item = results.get(timeout=remaining)
             except queue.Empty as ex:
-                logger.error('Timeout waiting for query response')
-                if not self.is_alive():
-                    self._invalid = True
-                    logger.error('Process terminated abnormally. Disabling it.')
-            except Exception as ex:
-                logger.error(str(ex), exc_info=True)
+                logger.error('Timeout waiting for %s response after %.1f seconds',
+                             command, timeout)
+                self.timeouts.record(command, timeout)
+                METRICS.count('timeouts')
+                return None, None
 
-            return resp
+            TRACER.complete('server', started, time.time(), command=command)
+            if item is None:
+                return None, None
+
+            resp, line = item
+            if qid is not None and isinstance(resp, dict) and resp.get('id') not in (None, qid):
+                logger.debug('Discarding late response for query %s', resp['id'])
+                METRICS.count('late_responses')
+                continue
 
-    def query_async(self, callback, command, **kwargs):
-        """ Runs a query in a separate thread reporting the result via an
+            self.timeouts.record(command, time.time() - started)
+            return resp, line
+
+    def load(self):
+        """ Number of queries either in flight or waiting to be issued """
+        return self._inflight + len(self.async_queries)
+
+    def query_async(self, callback, command, key=None, stale=None, priority=None, **kwargs):
+        """ Runs a query in a dispatcher thread reporting the result via an
             argument to the supplied callback.
+
+            Queries are issued by priority, which unless given is obtained
+            from the command (see PRIORITIES). A query with a `key` replaces
+            any pending one with the same key, which is then never run. If
+            `stale` is given it gets called just before sending the query,
+            returning True cancels it.
         """
-        self.async_queries.put((callback, command, kwargs))
+        if priority is None:
+            priority = PRIORITIES.get(command, NAVIGATION)
+        self.async_queries.put((callback, command, kwargs, stale, time.time()), key, priority)
+        METRICS.observe('async_queue', len(self.async_queries))
@@ -0,0 +1,199 @@
+"""
+Latency tracking used to adapt the time given to each query, and metrics
+about the traffic with the hint servers.
+"""
+
+import time
+import heapq
+import threading
+from collections import deque
+
+# Timeouts until enough latencies are known, a full compilation takes longer
+DEFAULT_TIMEOUTS = {
+    'parse': 10.0,
+    'globals': 10.0,
+    'builtins': 10.0,
+    'namespaces': 10.0,
+    'batch': 10.0,
+}
+
+
+class LatencyHistogram(object):
+    """ Rolling window with the latest latencies observed, in seconds """
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self._sorted = None
+
+    def percentile(self, p):
+        """ Latency below which the given percentage of samples fall """
+        if not self.samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+        idx = int(round((len(self._sorted) - 1) * p / 100.0))
+        return self._sorted[idx]
+
+
+class AdaptiveTimeouts(object):
+    """ Computes the time to wait for each command from its p99 latency
+        multiplied by `factor`, clamped between `floor` and `ceiling`. Until
+        `min_samples` latencies are known the default one is used.
+
+        Timed out queries count as taking the whole timeout, so a command
+        which is legitimately slow gets more time with each failure.
+    """
+
+    def __init__(self, factor=3.0, floor=0.5, ceiling=30.0, default=3.0,
+                 min_samples=20, size=200):
+        self.factor = factor
+        self.floor = floor
+        self.ceiling = ceiling
+        self.default = default
+        self.min_samples = min_samples
+        self.size = size
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, command):
+        with self.lock:
+            hist = self.histograms.get(command)
+            if hist is None:
+                hist = self.histograms[command] = LatencyHistogram(self.size)
+            return hist
+
+    def record(self, command, latency):
+        hist = self.histogram(command)
+        with self.lock:
+            hist.add(latency)
+
+    def timeout(self, command):
+        hist = self.histogram(command)
+        with self.lock:
+            if len(hist) < self.min_samples:
+                timeout = DEFAULT_TIMEOUTS.get(command, self.default)
+            else:
+                timeout = hist.percentile(99) * self.factor
+        return min(self.ceiling, max(self.floor, timeout))
+
+
+class Metrics(object):
+    """ Counters, gauges and latency histograms for the traffic with every
+        hint server, so slow commands and files can be spotted.
+    """
+
+    def __init__(self, size=1000, slowest=20):
+        self.size = size
+        self.max_slowest = slowest
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.since = time.time()
+            self.counters = {}
+            self.gauges = {}
+            # Per command stats: queries, bytes sent, bytes received, latencies
+            self.commands = {}
+            # Heap with the slowest queries as (latency, command, fname)
+            self.slowest = []
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """ Sets the current value of a gauge, keeping its maximum """
+        with self.lock:
+            gauge = self.gauges.get(name)
+            if gauge is None:
+                self.gauges[name] = [value, value]
+            else:
+                gauge[0] = value
+                gauge[1] = max(gauge[1], value)
+
+    def query(self, command, fname, latency, sent, received):
+        """ Record a query answered by a server """
+        with self.lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = [0, 0, 0, LatencyHistogram(self.size)]
+            stats[0] += 1
+            stats[1] += sent
+            stats[2] += received
+            stats[3].add(latency)
+
+            entry = (latency, command, fname or '')
+            if len(self.slowest) < self.max_slowest:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def snapshot(self):
+        """ Obtain all the metrics as a dict serializable to JSON """
+        with self.lock:
+            commands = {}
+            for command, (count, sent, received, hist) in self.commands.items():
+                commands[command] = {
+                    'count': count,
+                    'bytes_sent': sent,
+                    'bytes_received': received,
+                    'p50': hist.percentile(50),
+                    'p95': hist.percentile(95),
+                    'p99': hist.percentile(99),
+                    'max': hist.percentile(100),
+                }
+
+            hits = self.counters.get('cache_hits', 0)
+            lookups = hits + self.counters.get('cache_misses', 0)
+            return {
+                'elapsed': time.time() - self.since,
+                'counters': dict(self.counters),
+                'cache_hit_rate': float(hits) / lookups if lookups else None,
+                'gauges': dict((k, {'current': v[0], 'max': v[1]}) for k, v in self.gauges.items()),
+                'commands': commands,
+                'slowest': [
+                    {'latency': x[0], 'command': x[1], 'fname': x[2]}
+                    for x in sorted(self.slowest, reverse=True)
+                ],
+            }
+
+    def report(self):
+        """ Human readable summary of the metrics """
+        data = self.snapshot()
+        ms = lambda x: '{0:.1f}'.format(x * 1000) if x is not None else '-'
+
+        lines = ['Hint server metrics for the last {0:.0f} seconds'.format(data['elapsed']), '']
+        lines.append('{0:<12} {1:>7} {2:>9} {3:>9} {4:>9} {5:>9} {6:>10} {7:>10}'.format(
+            'command', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'sent', 'received'))
+        for command, stats in sorted(data['commands'].items()):
+            lines.append('{0:<12} {1:>7} {2:>9} {3:>9} {4:>9} {5:>9} {6:>10} {7:>10}'.format(
+                command, stats['count'], ms(stats['p50']), ms(stats['p95']),
+                ms(stats['p99']), ms(stats['max']), stats['bytes_sent'],
+                stats['bytes_received']))
+
+        lines.append('')
+        for name, value in sorted(data['counters'].items()):
+            lines.append('{0:<24} {1}'.format(name, value))
+        if data['cache_hit_rate'] is not None:
+            lines.append('{0:<24} {1:.1%}'.format('cache_hit_rate', data['cache_hit_rate']))
+        for name, gauge in sorted(data['gauges'].items()):
+            lines.append('{0:<24} {1} (max {2})'.format(name, gauge['current'], gauge['max']))
+
+        if data['slowest']:
+            lines.extend(['', 'Slowest queries:'])
+            for entry in data['slowest']:
+                lines.append('  {0:>9} ms  {1:<12} {2}'.format(
+                    ms(entry['latency']), entry['command'], entry['fname']))
+
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
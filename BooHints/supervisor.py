@@ -0,0 +1,121 @@
+"""
+Keeps the number of running hint server processes and their memory usage
+under control.
+"""
+
+import os
+import time
+import weakref
+import threading
+import logging
+# Optional dependency to measure memory usage outside of Linux
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from .reactor import TIMERS
+
+logger = logging.getLogger('boo.supervisor')
+
+
+def process_memory(pid):
+    """ Resident memory of a process in megabytes, None if unknown """
+    try:
+        with open('/proc/{0}/statm'.format(pid)) as fp:
+            pages = int(fp.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+
+    if psutil:
+        try:
+            return psutil.Process(pid).memory_info().rss / (1024.0 * 1024.0)
+        except Exception:
+            pass
+
+    return None
+
+
+class Supervisor(object):
+    """ Tracks the servers with a running process. When more than
+        `max_servers` are running, or together they use more than
+        `max_memory` megabytes, the least recently used idle ones are
+        stopped. They will spawn again with their next query.
+
+        Idle timeouts for every server are checked from a single periodic
+        sweep, which is only scheduled while some process is running.
+    """
+
+    def __init__(self, max_servers=8, max_memory=0, interval=30):
+        self.max_servers = max_servers
+        self.max_memory = max_memory
+        self.interval = interval
+        self.servers = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def configure(self, max_servers=None, max_memory=None):
+        if max_servers is not None:
+            self.max_servers = max_servers
+        if max_memory is not None:
+            self.max_memory = max_memory
+        self.enforce()
+
+    def started(self, server):
+        """ Notify that a server spawned its process """
+        with self.lock:
+            self.servers.add(server)
+            if self.timer is None:
+                self.timer = TIMERS.call_later(self.interval, self.sweep)
+        self.enforce(server)
+
+    def running(self):
+        """ Servers with a running process, least recently used first """
+        with self.lock:
+            servers = [x for x in self.servers if x.is_alive()]
+        return sorted(servers, key=lambda x: x.last_usage())
+
+    def sweep(self):
+        """ Periodic check stopping the servers idle for too long """
+        now = time.time()
+        for server in self.running():
+            if now - server.last_usage() > server.timeout and not server.is_busy():
+                logger.info('Stopping idle hint server %s', server.pid())
+                server.stop()
+
+        self.enforce()
+
+        with self.lock:
+            if any(x.is_alive() for x in self.servers):
+                self.timer = TIMERS.call_later(self.interval, self.sweep)
+            else:
+                self.timer = None
+
+    def enforce(self, keep=None):
+        """ Evict the least recently used idle servers until the limits are
+            honoured, never evicting `keep`.
+        """
+        # Stopping a server attached to the daemon just detaches it, its
+        # process is shared and the daemon stops it once unused.
+        servers = [x for x in self.running() if not x.is_shared()]
+        candidates = [x for x in servers if x is not keep and not x.is_busy()]
+
+        if self.max_servers:
+            while len(servers) > self.max_servers and candidates:
+                self.evict(candidates.pop(0), servers, 'too many servers')
+
+        if self.max_memory:
+            usage = dict((x, process_memory(x.pid()) or 0) for x in servers)
+            while sum(usage.values()) > self.max_memory and candidates:
+                server = candidates.pop(0)
+                usage.pop(server, None)
+                self.evict(server, servers, 'memory budget exceeded')
+
+    def evict(self, server, servers, reason):
+        logger.info('Evicting hint server %s: %s', server.pid(), reason)
+        servers.remove(server)
+        server.stop()
+
+
+SUPERVISOR = Supervisor()
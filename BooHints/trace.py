@@ -0,0 +1,100 @@
+"""
+Opt-in tracer recording the stages of each query as spans, which can be
+saved in the Trace Event format understood by chrome://tracing and Perfetto.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.complete(self.name, self.start, time.time(), **self.args)
+
+
+class Tracer(object):
+    """ Keeps the latest `size` spans while enabled. When disabled recording
+        a span costs a single attribute check.
+    """
+
+    def __init__(self, size=100000):
+        self.enabled = False
+        self.events = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # Names of the threads seen by their id
+        self.threads = {}
+
+    def span(self, name, **args):
+        """ Context manager recording the time spent in its block """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def complete(self, name, start, end, **args):
+        """ Record a span which already finished, times in seconds """
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': 'boo',
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self.pid,
+            'tid': thread.ident,
+            'args': args,
+        }
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append(event)
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self.threads.clear()
+
+    def dump(self, fname):
+        """ Save the recorded spans as a trace file """
+        with self.lock:
+            events = [
+                {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                 'args': {'name': name}}
+                for tid, name in self.threads.items()
+            ]
+            events.extend(self.events)
+        dirname = os.path.dirname(fname)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(fname, 'w') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+        return len(events) - len(self.threads)
+
+
+TRACER = Tracer()
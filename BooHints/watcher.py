@@ -0,0 +1,274 @@
+"""
+Watches the rsp files and referenced assemblies of the servers, so they can
+be refreshed as soon as a build replaces any of them instead of waiting for
+the compiler to notice it.
+
+On Linux the changes are reported by inotify through the shared reactor,
+elsewhere the files are polled from the timer thread.
+"""
+
+import os
+import glob
+import time
+import struct
+import fnmatch
+import threading
+import logging
+import ctypes
+import ctypes.util
+
+from .reactor import REACTOR, TIMERS, SELECTABLE_PIPES
+
+logger = logging.getLogger('boo.watcher')
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+
+IN_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+           IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def signature(fname):
+    """ Modification time and size of a file, None if missing """
+    try:
+        st = os.stat(fname)
+        return (st.st_mtime, st.st_size)
+    except OSError:
+        return None
+
+
+class Inotify(object):
+    """ Minimal binding for the Linux inotify API using ctypes """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.libc = libc
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.fileobj = os.fdopen(fd, 'rb', 0)
+
+    def add_watch(self, dirname, mask=IN_MASK):
+        wd = self.libc.inotify_add_watch(
+            self.fileobj.fileno(), dirname.encode('utf-8'), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', dirname)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fileobj.fileno(), wd)
+
+    @staticmethod
+    def parse(data):
+        """ Yields the watch descriptor and file name of each event """
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield wd, name.decode('utf-8', 'replace')
+
+
+class _Watch(object):
+
+    # Directories modified this recently are listed again, their timestamp
+    # may be too coarse to notice another change.
+    SETTLE = 2.0
+
+    def __init__(self, paths, callback, patterns=()):
+        self.paths = paths
+        self.patterns = patterns
+        self.callback = callback
+        # Listing the directories for the patterns is left to the timer
+        # thread, the files alone are just checked.
+        self.signatures = None if patterns else self.current()
+        self.pending = None
+        self.timer = None
+        # Signature of the directory and files matched for each pattern
+        self.listings = {}
+
+    def current(self):
+        signatures = [signature(x) for x in self.paths]
+        for pattern in self.patterns:
+            signatures.append(sorted((x, signature(x)) for x in self.glob(pattern)))
+        return signatures
+
+    def glob(self, pattern):
+        """ Files matching the pattern, its directory is only listed again
+            when it changed.
+        """
+        dirsig = signature(os.path.dirname(pattern))
+        listing = self.listings.get(pattern)
+        if (listing is None or listing[0] != dirsig or
+                dirsig is not None and time.time() - dirsig[0] < self.SETTLE):
+            listing = self.listings[pattern] = (dirsig, glob.glob(pattern))
+        return listing[1]
+
+    def matches(self, changed):
+        if changed.intersection(self.paths):
+            return True
+        return any(fnmatch.filter(changed, x) for x in self.patterns)
+
+    def dirs(self):
+        return set(os.path.dirname(x) for x in list(self.paths) + list(self.patterns))
+
+
+class Watcher(object):
+    """ Calls back when any of the files registered with a key changes. Bursts
+        of changes, like the ones from a build, are debounced reporting them
+        once no file changed for `debounce` seconds. Without inotify the
+        files are polled every `interval` seconds.
+    """
+
+    def __init__(self, debounce=1.0, interval=2.0):
+        self.debounce = debounce
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.watches = {}
+        self.inotify = None
+        # Watched directories by their descriptor and the other way round
+        self.dirs = {}
+        self.wds = {}
+        self.poller = None
+        self.polling = not SELECTABLE_PIPES
+
+    def watch(self, key, paths, callback, patterns=()):
+        """ Watch the files replacing any previous watch for the key. Files
+            matching the glob `patterns`, which may only use wildcards in
+            the file name, are watched too, even if created later.
+        """
+        paths = [os.path.abspath(x) for x in paths]
+        patterns = [os.path.abspath(x) for x in patterns]
+        with self.lock:
+            old = self.watches.get(key)
+            if old and old.paths == paths and old.patterns == patterns:
+                old.callback = callback
+                return
+            if old and old.timer:
+                old.timer.cancel()
+            watch = self.watches[key] = _Watch(paths, callback, patterns)
+            self.update_dirs()
+            if self.polling and self.poller is None:
+                self.poller = TIMERS.call_later(self.interval, self.poll)
+        if watch.signatures is None:
+            TIMERS.call_later(0, lambda: self.snapshot(watch))
+
+    def snapshot(self, watch):
+        """ Take the initial state of the watched files """
+        signatures = watch.current()
+        with self.lock:
+            if watch.signatures is None:
+                watch.signatures = signatures
+
+    def watching(self, key):
+        return key in self.watches
+
+    def unwatch(self, key=None):
+        """ Stop watching the files for the key, or every one if not given """
+        with self.lock:
+            keys = list(self.watches) if key is None else [key]
+            for k in keys:
+                watch = self.watches.pop(k, None)
+                if watch and watch.timer:
+                    watch.timer.cancel()
+            self.update_dirs()
+
+    def update_dirs(self):
+        """ Sync the inotify watches with the directories of the watched
+            files. Must be called while holding the lock.
+        """
+        if self.polling:
+            return
+
+        dirs = set()
+        for watch in self.watches.values():
+            dirs.update(watch.dirs())
+        try:
+            if self.inotify is None and dirs:
+                self.inotify = Inotify()
+                REACTOR.add_reader(self.inotify.fileobj, self.on_events, raw=True)
+            for dirname in dirs - set(self.wds):
+                if os.path.isdir(dirname):
+                    wd = self.inotify.add_watch(dirname)
+                    self.wds[dirname] = wd
+                    self.dirs[wd] = dirname
+        except (OSError, AttributeError) as ex:
+            logger.info('Unable to use inotify, polling files instead: %s', ex)
+            self.polling = True
+            self.poller = TIMERS.call_later(self.interval, self.poll)
+            return
+
+        for dirname in set(self.wds) - dirs:
+            wd = self.wds.pop(dirname)
+            self.dirs.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def on_events(self, data):
+        """ Called from the reactor with the inotify events read """
+        changed = set()
+        for wd, name in Inotify.parse(data):
+            dirname = self.dirs.get(wd)
+            if dirname is not None:
+                changed.add(os.path.join(dirname, name))
+
+        with self.lock:
+            for watch in self.watches.values():
+                if watch.matches(changed):
+                    self.trigger(watch)
+
+    def poll(self):
+        """ Periodic check of the watched files when inotify is missing """
+        with self.lock:
+            for watch in self.watches.values():
+                if watch.timer is None and watch.signatures is not None and \
+                        watch.current() != watch.signatures:
+                    self.trigger(watch)
+
+            if self.watches:
+                self.poller = TIMERS.call_later(self.interval, self.poll)
+            else:
+                self.poller = None
+
+    def trigger(self, watch):
+        """ (Re)start the debounce period of a watch. Must be called while
+            holding the lock.
+        """
+        if watch.timer:
+            watch.timer.cancel()
+        watch.pending = watch.current()
+        watch.timer = TIMERS.call_later(self.debounce, lambda: self.settle(watch))
+
+    def settle(self, watch):
+        """ Report the changes once the files stopped changing """
+        with self.lock:
+            watch.timer = None
+            current = watch.current()
+            if current != watch.pending:
+                # Still being written
+                self.trigger(watch)
+                return
+            if current == watch.signatures:
+                return
+            # Changed before the initial state was taken, nothing to compare
+            first = watch.signatures is None
+            watch.signatures = current
+            if first:
+                return
+
+        logger.info('Watched files changed: %s', ', '.join(watch.paths + watch.patterns))
+        try:
+            watch.callback()
+        except Exception as ex:
+            logger.error(str(ex), exc_info=True)
+
+
+WATCHER = Watcher()
@@ -32,6 +32,7 @@
         - ST3 has a view.show_popup_menu(items, onselect) API
         - Add support for "literate boo" .litboo / .boo.md
 """
+import os
 import sys
 import re
 import time
@@ -40,12 +41,19 @@ import logging
 import sublime
 import sublime_plugin
 
-from .BooHints import get_server, reset_servers, format_type, format_method, find_open_paren
+from .BooHints import server_key, get_server_by_key, reset_servers, watch_rsp, format_type, format_method, find_open_paren
+from .BooHints.supervisor import SUPERVISOR
+from .BooHints.trace import TRACER
+from .BooHints.daemon import default_socket
+from .BooHints.completion import CompletionSession
 
-# Try to reload dependencies (useful while developing the plugin)
+# Try to reload dependencies (useful while developing the plugin). Modules
+# holding process wide singletons (reactor, watcher, stats, trace and
+# supervisor) are left alone, otherwise the reloaded ones would use different
+# instances than the ones configured here.
 from imp import reload
 mod_prefix = '.'.join(__name__.split('.')[:-1])
-for mod in ('BooHints', 'BooHints.server'):
+for mod in ('BooHints', 'BooHints.cache', 'BooHints.recorder', 'BooHints.protocol', 'BooHints.server', 'BooHints.pool', 'BooHints.daemon', 'BooHints.completion'):
     reload(sys.modules[mod_prefix + '.' + mod])
 
 # HACK: Prevent crashes with broken pipe signals
@@ -77,47 +85,113 @@ IGNORED = (
 
 # Views initialized
 _INITIALIZED = set()
-# Keeps cached hints for builtin symbols associated to a view id
-_BUILTINS = {}
 # Keeps cached hints for global symbols associated to a view id
 _GLOBALS = {}
 # Keeps the last messages returned by the parse command associated to a view id
 _LINTS = {}
-# Keeps a cache of the last result associated to a view id
-_RESULT = {}
+# Keeps the completion session of the last result associated to a view id
+_SESSIONS = {}
+# Completion queries running in the background associated to a view id
+_PENDING = {}
+# Keeps the server key and options resolved for a file name
+_RESOLVED = {}
 
 
 def server(view):
     """ Obtain a server valid for the current view file. If a suitable one was
         already spawned it gets reused, otherwise a new one is created.
+        The server is made aware of the current contents of the view so
+        queries can refer to it just by its file name.
     """
-    fname = view.file_name()
-    cmd = get_setting('bin')
-    args = get_setting('args', [])
-    rsp = get_setting('rsp')
+    srv = resolve_server(view)
+    if srv:
+        srv.update_document(view.file_name(), view.change_count(), lambda: get_code(view))
+    return srv
+
 
+def resolve_server(view):
+    """ Obtain the server for the view without syncing its contents. Its
+        configuration is memoized per file until the settings or an rsp
+        file change.
+    """
+    fname = view.file_name()
+    resolved = _RESOLVED.get(fname)
+    if resolved is None:
+        cmd = get_setting('bin')
+        args = get_setting('args', [])
+        rsp = get_setting('rsp')
+        options = {
+            'workers': get_setting('workers', 1),
+            'sync_documents': get_setting('sync_documents', False),
+            'cache': None if get_setting('response_cache', True) else False,
+            'cache_dir': None,
+            'watch': get_setting('watch_references', True),
+            'timeouts': {
+                'floor': get_setting('timeout_floor', 0.5),
+                'ceiling': get_setting('timeout_ceiling', 30),
+            },
+            'record': None,
+            'framing': get_setting('framed_protocol', False),
+            'daemon': None,
+            'batching': get_setting('batch_queries', False),
+        }
+        daemon = get_setting('daemon', False)
+        if daemon:
+            options['daemon'] = default_socket() if daemon is True else os.path.expanduser(daemon)
+        if get_setting('record'):
+            options['record'] = os.path.expanduser(get_setting('record'))
+        if get_setting('disk_cache', True):
+            options['cache_dir'] = os.path.join(sublime.cache_path(), 'Boo')
+
+        resolved = (server_key(cmd, args, rsp=rsp, fname=fname), options)
+        _RESOLVED[fname] = resolved
+
+        # A build or another tool may create or change the rsp files
+        if rsp and options['watch']:
+            dirname = os.path.dirname(os.path.abspath(fname))
+            watch_rsp(('rsp', dirname, rsp), fname, rsp, reset_resolved)
+
+    key, options = resolved
     try:
-        return get_server(cmd, args, rsp=rsp, fname=fname)
+        return get_server_by_key(key, **options)
     except FileNotFoundError as ex:
         logger.error('Error spawning server: %s', ex)
 
 
+def reset_resolved():
+    """ Forget the resolved servers, forcing to look them up again
+    """
+    _RESOLVED.clear()
+
+
+def on_settings_change():
+    reset_resolved()
+    TRACER.enabled = get_setting('trace', False)
+    SUPERVISOR.configure(
+        max_servers=get_setting('max_servers', 8),
+        max_memory=get_setting('max_memory', 0))
+
+
 def get_setting(key, default=None):
     """ Search for the setting in Sublime using the "boo." prefix. If
         not found it will use the plugin settings file without the prefix
         to find a valid key. If still not found the default is returned.
     """
-    # Obtain settings from user preferences and/or project
-    settings = sublime.active_window().active_view().settings()
-
-    # Prefixed like `boo.rsp`
-    prefixed = '{0}.{1}'.format('boo', key)
-    if settings.has(prefixed):
-        return settings.get(prefixed)
-
-    # Inside a section named boo
-    if key in settings.get('boo', {}):
-        return settings.get('boo').get(key)
+    # Obtain settings from user preferences and/or project. There may be no
+    # view yet, for instance when starting with an empty window.
+    window = sublime.active_window()
+    view = window.active_view() if window else None
+    if view is not None:
+        settings = view.settings()
+
+        # Prefixed like `boo.rsp`
+        prefixed = '{0}.{1}'.format('boo', key)
+        if settings.has(prefixed):
+            return settings.get(prefixed)
+
+        # Inside a section named boo
+        if key in settings.get('boo', {}):
+            return settings.get('boo').get(key)
 
     # Query a custom settings file
     settings = sublime.load_settings('Boo.sublime-settings')
@@ -140,7 +214,6 @@ def query_locals(view, offset=None):
     resp = server(view).query(
         'locals',
         fname=view.file_name(),
-        code=get_code(view),
         line=line
     )
 
@@ -153,13 +226,13 @@ def query_complete(view, offset=None, code=None, line=None, skip_globals=True, *
         offset = view.sel()[0].a
     if line is None:
         line = view.rowcol(offset)[0] + 1
-    if code is None:
-        code = get_code(view)
+    # Unless given the code is taken from the synced document
+    if code is not None:
+        kwargs['code'] = code
 
     resp = server(view).query(
         'complete',
         fname=view.file_name(),
-        code=code or get_code(view),
         offset=offset,
         line=line,
         params=(skip_globals,),
@@ -238,61 +311,100 @@ def normalize_hints(hints):
 
     # Sort by symbol
     hints.sort(key=lambda x: x[1])
+    return hints
+
 
+def completion_result(hints):
     if not get_setting('defaults_complete'):
         hints = (hints, sublime.INHIBIT_EXPLICIT_COMPLETIONS | sublime.INHIBIT_WORD_COMPLETIONS)
 
     return hints
 
 
-def query_async(callback, view, command, delay=0, **kwargs):
-    """ Helper to issue commands asynchronously in sublime
+def query_async(callback, view, command, delay=0, stale=None, **kwargs):
+    """ Helper to issue commands asynchronously in sublime. A pending query
+        for the same view and command gets replaced by the new one, while
+        `stale` allows to cancel it if no longer needed once its turn comes.
     """
     def wrapper(result):
         # We need to route the actual callback via set_timeout
         # since it's the only sublime API which is thread safe
         if result:
-            sublime.set_timeout(lambda: callback(result), delay)
+            scheduled = time.time()
+            sublime.set_timeout(lambda: deliver(result, scheduled), delay)
+
+    def deliver(result, scheduled):
+        TRACER.complete('set_timeout', scheduled, time.time(), command=command)
+        # The result may have become stale while waiting for it
+        if not stale or not stale():
+            callback(result)
 
-    server(view).query_async(wrapper, command, **kwargs)
+    server(view).query_async(wrapper, command, key=(view.id(), command), stale=stale, **kwargs)
 
 
-def refresh_builtins(view, delay=0):
-    """ Refresh hints for builtin symbols asynchronously
+def get_builtins(view):
+    """ Hints for builtin symbols, shared by all the views using the same
+        server. Empty until the server has fetched them.
     """
-    def callback(result):
-        _BUILTINS[view.id()] = result['hints']
+    srv = resolve_server(view)
+    return (srv and srv.builtins()) or []
 
-    query_async(
-        callback,
-        view,
-        'builtins',
-        delay=delay,
-        fname=view.file_name(),
-        code=''
-    )
+
+def query_batch_async(callback, view, queries, delay=0, **kwargs):
+    """ Like `query_async` but issuing several queries in a single round
+        trip, the callback receives the list of responses.
+    """
+    def wrapper(results):
+        sublime.set_timeout(lambda: callback(results), delay)
+
+    server(view).query_batch_async(
+        wrapper, queries, key=(view.id(), 'batch'), fname=view.file_name(), **kwargs)
+
+
+def refresh_view(view, lint=True):
+    """ Refresh the globals and linting information of a view with a single
+        query to the server.
+    """
+    queries = []
+    if get_setting('globals_complete'):
+        queries.append({'command': 'globals'})
+    if lint:
+        queries.append({'command': 'parse', 'extra': True})
+    if not queries:
+        return
+
+    def callback(results):
+        for query, result in zip(queries, results):
+            if not result:
+                continue
+            if query['command'] == 'globals':
+                store_globals(view, result)
+            else:
+                store_lint(view, result)
+
+    query_batch_async(callback, view, queries)
+
+
+def store_globals(view, result):
+    _GLOBALS[view.id()] = result['hints']
 
 
 def refresh_globals(view, delay=0):
     """ Refresh hints for global symbols asynchronously
     """
-    def callback(result):
-        _GLOBALS[view.id()] = result['hints']
-
     if not get_setting('globals_complete'):
         return
 
     query_async(
-        callback,
+        lambda result: store_globals(view, result),
         view,
         'globals',
         delay=delay,
-        fname=view.file_name(),
-        code=get_code(view))
+        fname=view.file_name())
 
 
-def refresh_lint(view, delay=0):
-    """ Refreshes linting information asynchronously
+def store_lint(view, result):
+    """ Show the errors and warnings reported by a parse query
     """
     def process(lints, messages, key, mark='circle'):
         result = []
@@ -311,22 +423,24 @@ def refresh_lint(view, delay=0):
             sublime.HIDDEN  # | sublime.PERSISTENT
         )
 
-    def callback(result):
-        view_id = view.id()
-        if view_id in _LINTS:
-            _LINTS[view_id].clear()
-        else:
-            _LINTS[view_id] = {}
+    view_id = view.id()
+    if view_id in _LINTS:
+        _LINTS[view_id].clear()
+    else:
+        _LINTS[view_id] = {}
 
-        process(_LINTS[view_id], result, 'warnings', 'dot')
-        process(_LINTS[view_id], result, 'errors', 'circle')
+    process(_LINTS[view_id], result, 'warnings', 'dot')
+    process(_LINTS[view_id], result, 'errors', 'circle')
 
+
+def refresh_lint(view, delay=0):
+    """ Refreshes linting information asynchronously
+    """
     query_async(
-        callback,
+        lambda result: store_lint(view, result),
         view,
         'parse',
         fname=view.file_name(),
-        code=get_code(view),
         delay=delay,
         extra=True)  # Set to False to use a faster parser
 
@@ -353,7 +467,8 @@ def update_status():
         # Only process if we are not selecting text
         sel = view.sel()
         if len(sel) == 1 and sel[0].a == sel[0].b:
-            render_status(view, sel[0].a)
+            with TRACER.span('render_status'):
+                render_status(view, sel[0].a)
 
     sublime.set_timeout(update_status, 700)
 
@@ -408,13 +523,16 @@ def render_status(view, ofs):
         else:
             view.set_status('boo.sign', '{0} {1}'.format(symbol_for(hint), hint.get('type')))
 
+    def stale():
+        return STATUS_CACHE['view'] != view.id() or STATUS_CACHE['offset'] != ofs
+
     row, col = view.rowcol(ofs)
     query_async(
         callback,
         view,
         'entity',
+        stale=stale,
         fname=view.file_name(),
-        code=get_code(view),
         line=row + 1,
         column=col + 1,
         extra=True
@@ -439,7 +557,9 @@ class BooEventListener(sublime_plugin.EventListener):
         _INITIALIZED.clear()
         _LINTS.clear()
         _GLOBALS.clear()
-        _RESULT.clear()
+        _SESSIONS.clear()
+        _PENDING.clear()
+        _RESOLVED.clear()
 
     def on_query_context(self, view, key, operator, operand, match_all):
         """ Resolves context queries for keyboard bindings
@@ -469,21 +589,29 @@ class BooEventListener(sublime_plugin.EventListener):
                 logger.debug('Initializing view %d', view.id())
                 _INITIALIZED.add(view.id())
 
-                refresh_builtins(view)
-                refresh_globals(view)
-                refresh_lint(view)
+                # Project or view specific settings may change the server
+                view.settings().clear_on_change('boo.resolved')
+                view.settings().add_on_change('boo.resolved', reset_resolved)
+
+                # The builtins are prefetched as soon as the server spawns
+                refresh_view(view)
 
         initialize()
 
     def on_post_save(self, view):
+        # Changes to an rsp file may affect the resolved servers
+        fname = view.file_name() or ''
+        if fname.lower().endswith('.rsp'):
+            reset_resolved()
+
         if not is_supported_language(view):
             return
 
-        # Get hints for globals
-        refresh_globals(view)
+        # Give a server disabled after repeated crashes another chance
+        server(view).reset()
 
-        if get_setting('parse_on_save', True):
-            refresh_lint(view)
+        # Get hints for globals and lint it
+        refresh_view(view, lint=get_setting('parse_on_save', True))
 
     def on_close(self, view):
         """ Clean up caches when closing a view
@@ -491,17 +619,24 @@ class BooEventListener(sublime_plugin.EventListener):
         if not is_supported_language(view):
             return
 
+        srv = resolve_server(view)
+        if srv:
+            srv.close_document(view.file_name())
+
         view_id = view.id()
         if view_id in _GLOBALS:
             del _GLOBALS[view_id]
-        if view_id in _BUILTINS:
-            del _BUILTINS[view_id]
         if view_id in _LINTS:
             del _LINTS[view_id]
-        if view_id in _RESULT:
-            del _RESULT[view_id]
+        if view_id in _SESSIONS:
+            del _SESSIONS[view_id]
+        _PENDING.pop(view_id, None)
 
     def on_query_completions(self, view, prefix, locations):
+        with TRACER.span('on_query_completions'):
+            return self.query_completions(view, prefix, locations)
+
+    def query_completions(self, view, prefix, locations):
 
         if not is_supported_language(view) or not view.file_name():
             return
@@ -509,52 +644,132 @@ class BooEventListener(sublime_plugin.EventListener):
         start = time.time()
 
         vid = view.id()
-        offset = -1
-        line = ''
+        caret = locations[0]
+        offset, line = completion_start(view, caret)
+        context = completion_context(view, offset, line, caret)
+        prefix = view.substr(sublime.Region(offset, caret))
+
+        # Narrow the last result while typing the same word
+        session = _SESSIONS.get(vid)
+        if session and session.matches(context):
+            logger.debug('Reusing last result')
+            return completion_result(session.narrow(prefix))
+
+        # Never block typing waiting for the server
+        if get_setting('async_complete', False):
+            return query_completions_async(view, offset, context)
+
+        scope, hints = query_complete(view, offset)
+        hints = normalize_hints(completion_hints(view, scope, hints))
+        session = _SESSIONS[vid] = CompletionSession(context, hints, key=lambda x: x[1])
+        logger.debug('QueryCompletion: %d', (time.time()-start)*1000)
+        return completion_result(session.narrow(prefix))
+
+
+def completion_start(view, location):
+    """ Obtain the offset where the word being completed starts and the text
+        of its line before it.
+    """
+    # Find a preceding non-ident character in the line
+    offset = location
+    if view.substr(offset-1).isalnum() or view.substr(offset-1) == '_':
+        offset = view.word(offset).a
+
+    # Obtain the string from the start of the line until the caret
+    line = view.substr(sublime.Region(view.line(offset).a, offset))
+    return offset, line
+
+
+def completion_context(view, offset, line, caret):
+    """ Summary of what the completions for a word depend on. The size of
+        the buffer without the word detects edits anywhere else.
+    """
+    return (offset, line, view.scope_name(offset), view.size() - (caret - offset))
+
+
+def completion_hints(view, scope, hints):
+    """ Complement the hints of a complete query according to its scope,
+        converting them to completions.
+    """
+    vid = view.id()
+    if scope == 'name':
         hints = []
+    elif scope == 'import':
+        # Schedule a refresh globals
+        refresh_globals(view, 2000)
+    elif scope == 'type':
+        # Filter out everything but types in globals
+        items = get_builtins(view) + _GLOBALS.get(vid, [])
+        hints += (h for h in items if h['node'] in ('Type', 'Namespace'))
+    elif scope == 'members':
+        pass
+    elif scope == 'complete':
+        # Include builtins and globals
+        logger.info('Including builtins')
+        hints += get_builtins(view) + _GLOBALS.get(vid, [])
+    else:
+        logger.info('Unknown scope <%s>', scope)
 
-        def prepare_result(offset, hints):
-            hints = normalize_hints(hints)
-            _RESULT[vid] = (offset, line, hints)
-            logger.debug('QueryCompletion: %d', (time.time()-start)*1000)
-            return hints
+    return convert_hints(hints)
 
-        # Find a preceding non-ident character in the line
-        offset = locations[0]
-        if view.substr(offset-1).isalnum() or view.substr(offset-1) == '_':
-            offset = view.word(offset).a
 
-        # Obtain the string from the start of the line until the caret
-        line = view.substr(sublime.Region(view.line(offset).a, offset))
-        #logger.debug('Line: "%s"', line)
+def query_completions_async(view, offset, context):
+    """ Issue the complete query in the background, offering meanwhile the
+        builtins and globals already known. Once the response arrives the
+        completions popup is opened again with it, unless the caret moved
+        to a different word.
+    """
+    vid = view.id()
+    token = object()
+    _PENDING[vid] = token
 
-        # Try to optimize by comparing with the last execution
-        last_offset, last_line, last_result = _RESULT.get(vid, (-1, None, None))
-        if last_offset == offset and last_line == line:
-            logger.debug('Reusing last result')
-            return last_result
+    def callback(resp):
+        if _PENDING.get(vid) is not token:
+            return
+        del _PENDING[vid]
 
-        scope, hints = query_complete(view, offset)
-        if scope == 'name':
-            hints = []
-        elif scope == 'import':
-            # Schedule a refresh globals
-            refresh_globals(view, 2000)
-        elif scope == 'type':
-            # Filter out everything but types in globals
-            items = _BUILTINS.get(vid, []) + _GLOBALS.get(vid, [])
-            hints += (h for h in items if h['node'] in ('Type', 'Namespace'))
-        elif scope == 'members':
-            pass
-        elif scope == 'complete':
-            # Include builtins and globals
-            logger.info('Including builtins')
-            hints += _BUILTINS.get(vid, []) + _GLOBALS.get(vid, [])
-        else:
-            logger.info('Unknown scope <%s>', scope)
+        sel = view.sel()
+        if not len(sel):
+            return
+        caret = sel[0].b
+        start, line = completion_start(view, caret)
+        if completion_context(view, start, line, caret) != context:
+            logger.debug('Discarding completions for a different position')
+            return
+
+        hints = normalize_hints(completion_hints(view, resp['scope'], resp['hints']))
+        _SESSIONS[vid] = CompletionSession(context, hints, key=lambda x: x[1])
+        # Ask for the completions again, the last result is narrowed
+        view.run_command('hide_auto_complete')
+        view.run_command('auto_complete', {
+            'disable_auto_insert': True,
+            'next_completion_if_showing': False,
+        })
+
+    query_async(
+        callback, view, 'complete',
+        fname=view.file_name(),
+        offset=offset,
+        line=view.rowcol(offset)[0] + 1,
+        params=(True,),
+        # Superseded by a later completion request
+        stale=lambda: _PENDING.get(vid) is not token)
+
+    # Members depend on the expression, there is nothing to offer yet
+    if view.substr(offset - 1) == '.':
+        return []
+    return completion_result(normalize_hints(convert_hints(get_builtins(view) + _GLOBALS.get(vid, []))))
+
+
+def plugin_loaded():
+    """ Called by Sublime once its API is ready
+    """
+    for name in ('Boo.sublime-settings', 'Preferences.sublime-settings'):
+        settings = sublime.load_settings(name)
+        settings.clear_on_change('boo.resolved')
+        settings.add_on_change('boo.resolved', on_settings_change)
 
-        hints = convert_hints(hints)
-        return prepare_result(offset, hints)
+    on_settings_change()
 
 
 # Initialize the status updater
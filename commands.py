@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
+import os
 import re
+import json
 import sublime
 from sublime_plugin import TextCommand, WindowCommand
 
-from .SublimeBoo import server, get_code, convert_hint
+from .SublimeBoo import server, convert_hint
 from .BooHints import format_type, format_method, find_open_paren
+from .BooHints.stats import METRICS
+from .BooHints.trace import TRACER
 
 
 MEMBER_REGEX = re.compile(r'[\w\)\]]\.$')
@@ -90,23 +94,16 @@ class BooQuickPanelCompleteCommand(TextCommand):
             offset = word.a
             self.prefix = view.substr(word)
 
-        # Request member hints
-        resp = server(view).query(
-            'members',
-            fname=view.file_name(),
-            code=get_code(view),
-            offset=offset,
-            extra=True)
-        hints = resp['hints']
-
-        # For not member references ask for globals
+        # Request member hints, for not member references globals too
+        queries = [{'command': 'members', 'offset': offset, 'extra': True}]
         if view.substr(offset-1) != '.':
-            resp = server(view).query(
-                'globals',
-                fname=view.file_name(),
-                code=get_code(view),
-                extra=True)
-            hints += resp['hints']
+            queries.append({'command': 'globals', 'extra': True})
+
+        results = server(view).query_batch(queries, fname=view.file_name())
+        hints = []
+        for resp in results:
+            if resp:
+                hints += resp['hints']
 
         # TODO: Why doesn't it work with locals?
 
@@ -191,14 +188,10 @@ class BooBrowseNamespacesCommand(TextCommand):
         self.list = []
         items = []
 
-        resp = server(view).query(
-            'namespaces',
-            fname=view.file_name(),
-            code='',
-        )
+        hints = server(view).namespaces(block=True) or []
         from .SublimeBoo import symbol_for
         seen = set()
-        for hint in resp['hints']:
+        for hint in hints:
             if hint['full'] not in seen and hint['node'] == 'Namespace':
                 seen.add(hint['full'])
                 self.list.append(hint['full'])
@@ -222,16 +215,10 @@ class BooBrowseNamespacesCommand(TextCommand):
             [u'⟳ ' + fullname],
         ]
 
-        resp = server(self.view).query(
-            'members',
-            fname=self.view.file_name(),
-            code='{0}.'.format(fullname),
-            offset=len(fullname)+1,
-            extra=True
-        )
+        hints = server(self.view).type_members(fullname, block=True) or []
 
         from .SublimeBoo import symbol_for
-        for hint in resp['hints']:
+        for hint in hints:
             self.list.append(hint['full'])
             items.append([
                 '{0} {1}'.format(symbol_for(hint), hint['name'])
@@ -332,17 +319,10 @@ class BooShowInfoCommand(TextCommand):
         elif word.isalnum() and word not in ('if', 'elif', 'else', 'for', 'while', 'try', 'except', 'ensure', 'def', 'class', 'struct', 'interface', 'continue', 'return', 'yield', 'true', 'false', 'null', 'in', 'of'):
             ofs = view.word(ofs).a
 
-        # Comment out the end of line to try to make it compile without errors
-        until = view.word(ofs).b
-        code = get_code(view)
-        #code = code[0:until] + ' # ' + code[until:]
-        print('CODE:', code[until-5:until+5])
-
         row, col = view.rowcol(ofs)
         resp = server(view).query(
             'entity',
             fname=view.file_name(),
-            code=code,
             line=row + 1,
             column=col + 1,
             extra=True,
@@ -378,6 +358,48 @@ class BooShowInfoCommand(TextCommand):
         self.view.window().run_command('show_panel', {'panel': 'output.boo.info'})
 
 
+class BooShowStatsCommand(WindowCommand):
+    """ Shows the metrics about the traffic with the hint servers in an
+        output panel, or exports them as JSON into a new view.
+    """
+
+    def run(self, export=False, reset=False):
+        if reset:
+            METRICS.reset()
+            return
+
+        if export:
+            view = self.window.new_file()
+            view.set_name('boo-stats.json')
+            view.set_syntax_file('Packages/JavaScript/JSON.tmLanguage')
+            view.run_command('append', {
+                'characters': json.dumps(METRICS.snapshot(), indent=2, sort_keys=True)})
+            return
+
+        panel = self.window.get_output_panel('boo.stats')
+        panel.run_command('select_all')
+        panel.run_command('right_delete')
+        panel.run_command('append', {'characters': METRICS.report()})
+        panel.show(0)
+        self.window.run_command('show_panel', {'panel': 'output.boo.stats'})
+
+
+class BooSaveTraceCommand(WindowCommand):
+    """ Saves the spans recorded by the tracer to a file which can be
+        opened in chrome://tracing or Perfetto.
+    """
+
+    def run(self):
+        if not TRACER.enabled:
+            sublime.status_message('Boo: Tracing is disabled, enable the "trace" setting')
+            return
+
+        fname = os.path.join(sublime.cache_path(), 'Boo', 'trace.json')
+        count = TRACER.dump(fname)
+        TRACER.clear()
+        sublime.status_message('Boo: Saved {0} spans to {1}'.format(count, fname))
+
+
 class BooOutlineCommand(TextCommand):
     """ Generate an outline for the current file
 
@@ -390,8 +412,7 @@ class BooOutlineCommand(TextCommand):
     def run(self, edit):
         resp = server(self.view).query(
             'outline',
-            fname=self.view.file_name(),
-            code=get_code(self.view))
+            fname=self.view.file_name())
 
         view = self.view.window().get_output_panel('boo.outline')
         view.insert(edit, view.size(), '\n'.join(self.render(resp)))
@@ -427,8 +448,7 @@ class BooGoToImportsCommand(TextCommand):
     def run(self, edit):
         resp = server(self.view).query(
             command='outline',
-            fname=self.view.file_name(),
-            code=get_code(self.view)
+            fname=self.view.file_name()
         )
 
         imports = [x for x in resp['members'] if x['type'] == 'Import']
@@ -476,8 +496,7 @@ class BooGoToEnclosingTypeCommand(TextCommand):
     def run(self, edit):
         resp = server(self.view).query(
             command='outline',
-            fname=self.view.file_name(),
-            code=get_code(self.view)
+            fname=self.view.file_name()
         )
 
         ofs = self.view.sel()[-1].a
@@ -532,7 +551,6 @@ class BooGoToDeclarationCommand(TextCommand):
         resp = server(self.view).query(
             'entity',
             fname=self.view.file_name(),
-            code=get_code(self.view),
             line=row + 1,
             column=col + 1,
             extra=True